@@ -0,0 +1,54 @@
+import sys
+import math
+import time
+import numpy as np
+import pandas as pd
+from spikes_medfilt_v2 import calculate_velocity, calculate_angular_observables
+
+
+# The Series.apply implementation calculate_angular_observables replaced, kept for timing
+def legacy_angular_observables(data):
+    data['Slope'] = data['Y'].diff() / data['X'].diff()
+    data['Slope'] = data['Slope'].fillna(0)
+    data['Theta'] = data['Slope'].apply(lambda slope: math.atan(slope) if not math.isnan(slope) else None)
+    data['Theta'] = np.degrees(data['Theta'])
+    data['Theta'] = data['Theta'].fillna(0)
+    data['Cosine'] = data['Theta'].apply(lambda theta: math.cos(theta) if not math.isnan(theta) else None)
+    data['Theta_diff'] = data['Theta'].diff()
+    data['Theta_diff'] = data['Theta_diff'].fillna(0)
+    return data
+
+
+# One cow's track at 1 Hz as a random walk in mm
+def make_track(n, seed=0):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'ID': 2417246,
+        'Timestamp': pd.to_datetime(1573776000000 + np.arange(n) * 1000, unit='ms'),
+        'X': np.cumsum(rng.integers(-100, 101, n)) + 1500,
+        'Y': np.cumsum(rng.integers(-100, 101, n)) + 10000,
+        'Z': 0,
+    })
+    return calculate_velocity(data)
+
+
+def main(n=10**6):
+    data = make_track(n)
+
+    start = time.perf_counter()
+    legacy_angular_observables(data.copy())
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    calculate_angular_observables(data.copy())
+    t_vectorized = time.perf_counter() - start
+
+    print(f"rows: {n}")
+    print(f"Series.apply:  {t_legacy:.4f} s")
+    print(f"vectorized:    {t_vectorized:.4f} s")
+    print(f"speedup:       {t_legacy / t_vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+
+    main(int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6)
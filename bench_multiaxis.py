@@ -0,0 +1,48 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from synthetic_fa import generate_FA_day
+from spikes_medfilt_v2 import (FAIndex, remove_herd_spikes, remove_herd_spikes_multiaxis, clean_herd_positions,
+                               calculate_herd_kinematics)
+
+
+# Y-only spike removal (the current path) against joint X/Y and X/Y/Z removal on one
+# synthetic herd day, timing the spike stage alone and spike removal + kinematics.
+#
+#   python bench_multiaxis.py [N_TAGS]
+
+def herd_day(n_tags, seed=0):
+    frame, _ = generate_FA_day(pd.Timestamp('2020-09-19').date(), n_tags, n_stationary=0, seed=seed)
+    return FAIndex(frame.drop(columns=['Column1', 'Column3'])).data
+
+
+def timed(func):
+    start = time.perf_counter()
+    out = func()
+    return time.perf_counter() - start, out
+
+
+def main(n_tags=50, spike_threshold=200):
+    data = herd_day(n_tags)
+    print(f"rows: {len(data)}")
+
+    t_y, (_, spikes_y) = timed(lambda: remove_herd_spikes(data, spike_threshold))
+    t_xy, (_, spikes_xy) = timed(lambda: remove_herd_spikes_multiaxis(data, spike_threshold))
+    t_xyz, (_, spikes_xyz) = timed(lambda: remove_herd_spikes_multiaxis(data, spike_threshold, axes=('X', 'Y', 'Z')))
+    print(f"{'spike stage':<28} {'seconds':>9} {'spikes':>9}")
+    print(f"{'Y only':<28} {t_y:>9.3f} {int(spikes_y.sum()):>9}")
+    print(f"{'X+Y joint':<28} {t_xy:>9.3f} {int(spikes_xy.sum()):>9}")
+    print(f"{'X+Y+Z joint':<28} {t_xyz:>9.3f} {int(spikes_xyz.sum()):>9}")
+
+    # full stage: Y-only removal next to kinematics on raw X/Y, versus kinematics on the cleaned track
+    t_old, old = timed(lambda: (calculate_herd_kinematics(data), remove_herd_spikes(data, spike_threshold)))
+    t_new, new = timed(lambda: calculate_herd_kinematics(clean_herd_positions(data, spike_threshold)))
+    print(f"{'spikes + kinematics':<28} {'seconds':>9} {'velocity p95':>13}")
+    print(f"{'Y only, raw kinematics':<28} {t_old:>9.3f} {np.percentile(old[0]['Velocity'], 95):>13.1f}")
+    print(f"{'X+Y joint, clean kinematics':<28} {t_new:>9.3f} {np.percentile(new['Velocity'], 95):>13.1f}")
+
+
+if __name__ == "__main__":
+
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,233 @@
+import os
+import gc
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+from synthetic_fa import generate_FA_files
+from trajectory_store import TrajectoryStore
+from streaming_pipeline import StreamingPipeline, iter_FA_chunks, scan_tag_ranges
+from pipeline_dag import run_job
+from spikes_medfilt_v2 import (read_FA_file, fa_cache_path, load_FA_arrays, detect_drop_inactive_tags, build_FA_index,
+                               get_individual, get_interval, calculate_herd_kinematics, remove_herd_spikes,
+                               combined_plots, angular_plots)
+
+
+# Stage-by-stage benchmark of the pipeline on synthetic FA data, from one cow-hour up to
+# 200 cows x 30 days. Every stage is timed and its peak traced memory recorded, as is the
+# resident size of the data it returns (DataFrame vs TrajectoryStore). Plotting is timed
+# on the matplotlib scatter path (small scales only) and the raster path. Scales above
+# IN_MEMORY_MAX_ROWS do not fit in memory as a DataFrame (200x30 is about 500M rows); they
+# are timed on the bounded-memory paths instead: column cache, streaming kinematics and
+# spike removal, and one cow through pipeline_dag. Results go to a JSON file that can be
+# compared with an earlier run (--compare).
+#
+#   python bench_pipeline.py --scales 1x1h 10x1 200x1 --output bench.json
+#   python bench_pipeline.py --scales 200x1 --compare bench.json
+
+DEFAULT_SCALES = ['1x1h', '10x1', '200x1']
+ALL_SCALES = ['1x1h', '10x1', '200x1', '200x7', '200x30']
+DATA_DIR = 'bench_data'
+REGRESSION_RATIO = 1.2
+# the matplotlib scatter path draws one marker per sample; above this many rows of one cow
+# it takes minutes and is skipped
+SCATTER_MAX_ROWS = 100000
+# rows (at 1 Hz) above which the in-memory DataFrame and TrajectoryStore stages are skipped
+IN_MEMORY_MAX_ROWS = 50000000
+
+
+# '200x7' -> 200 tags for 7 days, '1x1h' -> 1 tag for 1 hour
+def parse_scale(scale):
+    tags, span = scale.lower().split('x')
+    if span.endswith('h'):
+        return int(tags), 1, float(span[:-1])
+    return int(tags), int(span), 24
+
+
+def scale_files(scale, data_dir=DATA_DIR, seed=0):
+    n_tags, days, hours = parse_scale(scale)
+    directory = os.path.join(data_dir, scale)
+    n_stationary = n_tags // 20
+    expected = [os.path.join(directory, f"FA_{day:%Y%m%d}T000000UTC.csv")
+                for day in pd.date_range('2020-09-19', periods=days, freq='D')]
+    if all(os.path.exists(f) for f in expected):
+        return expected
+    print(f"Generating {scale} ...")
+    return generate_FA_files(directory, n_tags, days, n_stationary=n_stationary, hours=hours, seed=seed)
+
+
+# Memory held by a stage's output: DataFrame columns (deep) or TrajectoryStore arrays
+def resident_mb(out):
+    if isinstance(out, pd.DataFrame):
+        return out.memory_usage(deep=True).sum() / 2**20
+    if isinstance(out, TrajectoryStore):
+        return out.memory_usage()['total'] / 2**20
+    return None
+
+
+class StageTimer:
+    def __init__(self, scale, trace_memory=True):
+        self.scale = scale
+        self.trace_memory = trace_memory
+        self.results = []
+
+    # Run func(), record its wall time, peak traced memory, row counts and the size of its output
+    def run(self, stage, func, rows_in=None):
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        out = func()
+        seconds = time.perf_counter() - start
+        peak_mb = None
+        if self.trace_memory:
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        first = out[0] if isinstance(out, tuple) else out
+        rows_out = len(first) if isinstance(first, (pd.DataFrame, pd.Series, np.ndarray)) else None
+        if isinstance(first, TrajectoryStore):
+            rows_out = len(first)
+        size_mb = resident_mb(first)
+        self.results.append({'scale': self.scale, 'stage': stage, 'seconds': seconds, 'peak_mb': peak_mb,
+                             'rows_in': rows_in, 'rows_out': rows_out, 'resident_mb': size_mb})
+        print(f"{self.scale:>8} {stage:<28} {seconds:>9.3f} s  "
+              f"{'' if peak_mb is None else f'{peak_mb:>9.1f} MB'}  rows {rows_in} -> {rows_out}"
+              f"{'' if size_mb is None else f'  holds {size_mb:.1f} MB'}")
+        return out
+
+
+def bench_scale(scale, trace_memory=True, output_dir='bench_plots'):
+    files = scale_files(scale)
+    timer = StageTimer(scale, trace_memory)
+
+    # first read parses the CSV and builds the column cache, the second one uses the cache
+    for f in files:
+        cache = fa_cache_path(f)
+        for name in os.listdir(cache) if os.path.isdir(cache) else []:
+            os.remove(os.path.join(cache, name))
+    n_tags, days, hours = parse_scale(scale)
+    if n_tags * days * hours * 3600 > IN_MEMORY_MAX_ROWS:
+        return bench_scale_streaming(scale, files, timer, output_dir)
+    timer.run('read_FA_file (csv)', lambda: pd.concat([read_FA_file(f) for f in files]))
+    data = timer.run('read_FA_file (cached)', lambda: pd.concat([read_FA_file(f) for f in files], ignore_index=True))
+    rows = len(data)
+
+    data = timer.run('detect_drop_inactive_tags', lambda: detect_drop_inactive_tags(data), rows)
+    index = timer.run('build_FA_index', lambda: build_FA_index(data), len(data))
+
+    # a 15-minute window of one cow, as in main()
+    tag = index.tags[0]
+    start = pd.to_datetime(int(index.timestamps[index.tag_bounds(tag)[0]]), unit='ms') + pd.Timedelta(minutes=5)
+    end = start + pd.Timedelta(minutes=15)
+    window = timer.run('get_individual+get_interval', lambda: get_interval(get_individual(index, tag), start, end), len(index))
+
+    herd = timer.run('kinematics (herd)', lambda: calculate_herd_kinematics(index), len(index))
+    fixed, spikes = timer.run('remove_spikes (herd)', lambda: remove_herd_spikes(herd, 200), len(herd))
+
+    # the same kinematics on the compact store, derived columns materialized on request
+    store = timer.run('TrajectoryStore.from_files', lambda: TrajectoryStore.from_files(files).drop_inactive())
+    timer.run('kinematics (store)', lambda: _store_kinematics(store), len(store))
+
+    # plots of one cow over the whole span
+    os.makedirs(output_dir, exist_ok=True)
+    cow = herd[herd['ID'] == tag]
+    cow_fixed, cow_spikes = fixed[herd['ID'] == tag], spikes[herd['ID'] == tag]
+    v_thr, a_thr = np.percentile(cow['Velocity'], 95), np.percentile(cow['Acceleration'], 95)
+    if len(cow) <= SCATTER_MAX_ROWS:
+        timer.run('plotting (scatter)', lambda: [
+            combined_plots(cow, cow_fixed, cow_spikes, v_thr, a_thr, os.path.join(output_dir, f'com_scatter_{scale}.png')),
+            angular_plots(cow, cow_spikes, os.path.join(output_dir, f'ang_scatter_{scale}.png'))], len(cow))
+    timer.run('plotting (raster)', lambda: [
+        combined_plots(cow, cow_fixed, cow_spikes, v_thr, a_thr, os.path.join(output_dir, f'com_{scale}.png'), raster=True),
+        angular_plots(cow, cow_spikes, os.path.join(output_dir, f'ang_{scale}.png'), raster=True)], len(cow))
+    del window
+    return timer.results
+
+
+# Stages of a scale too large for memory: only per-file, per-chunk or per-cow data is held
+def bench_scale_streaming(scale, files, timer, output_dir='bench_plots'):
+    rows = timer.run('column cache (csv)', lambda: sum(len(load_FA_arrays(f, ['ID'])['ID']) for f in files))
+    ranges = timer.run('scan_tag_ranges', lambda: scan_tag_ranges(files), rows)
+    stationary = ranges.index[ranges['Y_range'].abs() <= 2600]
+    timer.run('kinematics+spikes (streaming)', lambda: _stream_rows(files, stationary), rows)
+
+    # one cow over the whole span, its rows pushed down into loading
+    tag = ranges.index[~ranges.index.isin(stationary)][0]
+    cow = timer.run('pipeline_dag (one cow)', lambda: run_job({'files': files, 'tags': [int(tag)], 'outputs': ['table']})['table'], rows)
+    v_thr, a_thr = np.percentile(cow['Velocity'], 95), np.percentile(cow['Acceleration'], 95)
+    os.makedirs(output_dir, exist_ok=True)
+    timer.run('plotting (raster)', lambda: [
+        combined_plots(cow, cow['Y_fixed'], cow['Spike'], v_thr, a_thr, os.path.join(output_dir, f'com_{scale}.png'), raster=True),
+        angular_plots(cow, cow['Spike'], os.path.join(output_dir, f'ang_{scale}.png'), raster=True)], len(cow))
+    return timer.results
+
+
+# Run the streaming pipeline over the files and drop its output; returns the rows processed
+def _stream_rows(files, stationary):
+    pipeline = StreamingPipeline(200, stationary_tags=stationary)
+    rows = 0
+    for filename in files:
+        for chunk in iter_FA_chunks(filename):
+            rows += len(pipeline.process(chunk))
+    return rows + len(pipeline.flush())
+
+
+def _store_kinematics(store):
+    store.materialize(['Velocity', 'Acceleration', 'Theta_diff', 'Angular_velocity'])
+    return store
+
+
+def metadata():
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+# Print the time ratio of every (scale, stage) against a previous JSON result
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(r['scale'], r['stage']): r for r in json.load(f)['results']}
+    print(f"\n{'scale':>8} {'stage':<28} {'before':>9} {'after':>9} {'ratio':>7}")
+    for r in results:
+        old = baseline.get((r['scale'], r['stage']))
+        if old is None:
+            continue
+        ratio = r['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        flag = '  REGRESSION' if ratio > REGRESSION_RATIO else ''
+        print(f"{r['scale']:>8} {r['stage']:<28} {old['seconds']:>9.3f} {r['seconds']:>9.3f} {ratio:>7.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage-by-stage pipeline benchmark on synthetic FA data.')
+    parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES,
+                        help=f"TAGSxDAYS or TAGSxHOURSh, e.g. {' '.join(ALL_SCALES)}")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier JSON result to compare against')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc (lower overhead)')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        results += bench_scale(scale, trace_memory=not args.no_memory)
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': metadata(), 'results': results}, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,67 @@
+import sys
+import time
+import numpy as np
+from scipy.signal import medfilt
+from rolling_median import RollingMedian, rolling_median, segmented_rolling_median
+
+
+# Time a function call, best of `repeat` runs
+def best_time(func, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Y-like test signal: a slow random walk in mm with 1% spikes
+def make_signal(n, seed=0):
+    rng = np.random.default_rng(seed)
+    y = np.cumsum(rng.normal(0, 50, n)) + 10000
+    spikes = rng.random(n) < 0.01
+    y[spikes] += rng.normal(0, 3000, spikes.sum())
+    return y.astype(np.int32)
+
+
+# Stream n samples through RollingMedian and check that the heaps stay bounded by the
+# window (removed values are dropped lazily) and that the medians match the batch filter
+def check_heap_memory(n=200000, kernel_size=41):
+    rng = np.random.default_rng(1)
+    signals = {'rising': np.arange(n, dtype=np.float64), 'random walk': np.cumsum(rng.normal(0, 50, n)).round()}
+    for name, y in signals.items():
+        engine = RollingMedian(kernel_size)
+        medians = np.array([engine.push(value) for value in y])
+        sizes = len(engine.low) + len(engine.high), len(engine.pending)
+        print(f"{name}: {sizes[0]} heap entries, {sizes[1]} pending keys after {n} samples")
+        assert sizes[0] <= 2 * kernel_size + 2 and sizes[1] <= kernel_size + 1
+        # streaming medians of the last kernel_size samples are the batch medians shifted by `right`
+        right = kernel_size - 1 - kernel_size // 2
+        assert np.array_equal(medians[kernel_size - 1:], rolling_median(y, kernel_size)[kernel_size - 1 - right:n - right])
+
+
+def main(sizes=(10**5, 10**6, 10**7), kernel_size=41, heap_limit=10**5, n_tags=200):
+    print(f"kernel_size={kernel_size}")
+    print(f"{'samples':>10} {'medfilt':>10} {'rank':>10} {'segmented':>10} {'heap':>10}")
+    for n in sizes:
+        y = make_signal(n)
+        t_medfilt = best_time(lambda: medfilt(y, kernel_size))
+        t_rank = best_time(lambda: rolling_median(y, kernel_size))
+
+        # the same samples split into n_tags tags, filtered in one call
+        starts = np.zeros(n, dtype=bool)
+        starts[np.linspace(0, n, n_tags, endpoint=False).astype(int)] = True
+        t_segmented = best_time(lambda: segmented_rolling_median(y, starts, kernel_size))
+
+        # the pure-Python two-heap engine is meant for streaming, only time it on small inputs
+        t_heap = best_time(lambda: rolling_median(y, kernel_size, method='heap'), repeat=1) if n <= heap_limit else float('nan')
+
+        assert np.array_equal(rolling_median(y, kernel_size), medfilt(y, kernel_size))
+        print(f"{n:>10} {t_medfilt:>10.4f} {t_rank:>10.4f} {t_segmented:>10.4f} {t_heap:>10.4f}")
+
+
+if __name__ == "__main__":
+
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or (10**5, 10**6, 10**7)
+    main(sizes)
+    check_heap_memory()
@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from spikes_medfilt_v2 import _timestamps_as_ms
+
+
+# Contact network between cows: all tags are put on a common 1 s time base, pairs closer
+# than a distance threshold are found per second with a uniform-grid spatial hash, and
+# the seconds in contact are summed into one edge per cow pair and day. Time blocks are
+# independent, so pair detection runs in parallel across blocks.
+
+CONTACT_DISTANCE_MM = 1000
+# The cell itself and the neighbours to its right and above: every pair of neighbouring
+# cells is visited exactly once
+HALF_NEIGHBOURHOOD = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+
+# One position per tag and time step: the last sample of the tag in that step
+def align_to_time_base(data, step_s=1):
+    ms = _timestamps_as_ms(data['Timestamp'])
+    aligned = pd.DataFrame({
+        'ID': data['ID'].to_numpy(),
+        'Second': ms // int(step_s * 1000) * step_s,
+        'X': data['X'].to_numpy(dtype=np.float64),
+        'Y': data['Y'].to_numpy(dtype=np.float64),
+        '_ms': ms,
+    })
+    aligned = aligned.sort_values(['Second', 'ID', '_ms'], kind='stable')
+    aligned = aligned.drop_duplicates(['Second', 'ID'], keep='last')
+    return aligned.drop(columns='_ms').reset_index(drop=True)
+
+
+# Row indices of all point pairs in the same or neighbouring cells within each second.
+# Points must be sorted by their hash key.
+def _candidate_pairs(key, nx):
+    n = len(key)
+    first, second = [], []
+    for dx, dy in HALF_NEIGHBOURHOOD:
+        target = key + dy * nx + dx
+        hi = np.searchsorted(key, target, side='right')
+        if (dx, dy) == (0, 0):
+            lo = np.arange(1, n + 1)    # only the later points of the same cell
+        else:
+            lo = np.searchsorted(key, target, side='left')
+        counts = np.maximum(hi - lo, 0)
+        i = np.repeat(np.arange(n), counts)
+        j = lo[i] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        first.append(i)
+        second.append(j)
+    return np.concatenate(first), np.concatenate(second)
+
+
+# All pairs closer than distance_mm among aligned positions (one block of seconds)
+def contact_pairs(aligned, distance_mm=CONTACT_DISTANCE_MM):
+    empty = pd.DataFrame({'Second': [], 'ID_a': [], 'ID_b': [], 'Distance': []})
+    if len(aligned) < 2:
+        return empty
+    second = aligned['Second'].to_numpy(dtype=np.int64)
+    ids = aligned['ID'].to_numpy()
+    x = aligned['X'].to_numpy()
+    y = aligned['Y'].to_numpy()
+
+    # spatial hash: cells of distance_mm, padded by one cell so neighbours never wrap
+    cx = np.floor(x / distance_mm).astype(np.int64)
+    cy = np.floor(y / distance_mm).astype(np.int64)
+    cx -= cx.min() - 1
+    cy -= cy.min() - 1
+    nx, ny = cx.max() + 2, cy.max() + 2
+    key = ((second - second.min()) * ny + cy) * nx + cx
+    order = np.argsort(key, kind='stable')
+    key, second, ids, x, y = key[order], second[order], ids[order], x[order], y[order]
+
+    i, j = _candidate_pairs(key, nx)
+    distance = np.hypot(x[i] - x[j], y[i] - y[j])
+    close = distance <= distance_mm
+    i, j = i[close], j[close]
+    if len(i) == 0:
+        return empty
+    return pd.DataFrame({
+        'Second': second[i],
+        'ID_a': np.minimum(ids[i], ids[j]),
+        'ID_b': np.maximum(ids[i], ids[j]),
+        'Distance': distance[close],
+    })
+
+
+# Contact duration per cow pair and day. Seconds in contact less than max_gap_s apart
+# belong to the same episode.
+def contact_edges(pairs, step_s=1, max_gap_s=5):
+    columns = ['Day', 'ID_a', 'ID_b', 'Contact_s', 'Episodes', 'First', 'Last']
+    if len(pairs) == 0:
+        return pd.DataFrame(columns=columns)
+    pairs = pairs.sort_values(['ID_a', 'ID_b', 'Second'], kind='stable')
+    pairs['Day'] = pd.to_datetime(pairs['Second'], unit='s').dt.normalize()
+    a, b, sec = pairs['ID_a'].to_numpy(), pairs['ID_b'].to_numpy(), pairs['Second'].to_numpy()
+    new_episode = np.ones(len(pairs), dtype=bool)
+    new_episode[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1]) | (sec[1:] - sec[:-1] > max_gap_s)
+    pairs['Episode'] = new_episode
+
+    edges = pairs.groupby(['Day', 'ID_a', 'ID_b']).agg(
+        Contact_s=('Second', 'size'), Episodes=('Episode', 'sum'), First=('Second', 'min'), Last=('Second', 'max'))
+    edges['Contact_s'] *= step_s
+    edges['First'] = pd.to_datetime(edges['First'], unit='s')
+    edges['Last'] = pd.to_datetime(edges['Last'], unit='s')
+    return edges.reset_index()[columns]
+
+
+def _block_pairs(args):
+    aligned, distance_mm = args
+    return contact_pairs(aligned, distance_mm)
+
+
+# Full contact network of FA data: align, find pairs per time block on a process pool,
+# and sum the contacts into per-day edges
+def contact_network(data, distance_mm=CONTACT_DISTANCE_MM, step_s=1, block_s=3600, workers=None, max_gap_s=5):
+    aligned = align_to_time_base(data, step_s)
+    block = aligned['Second'].to_numpy() // block_s
+    bounds = np.flatnonzero(np.r_[True, block[1:] != block[:-1], True])
+    tasks = [(aligned.iloc[s:e], distance_mm) for s, e in zip(bounds[:-1], bounds[1:])]
+
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(tasks) == 1:
+        parts = [_block_pairs(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_block_pairs, tasks))
+    pairs = pd.concat(parts, ignore_index=True) if parts else contact_pairs(aligned.iloc[0:0])
+    return contact_edges(pairs, step_s, max_gap_s)
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from spikes_medfilt_v2 import FA_CACHE_DTYPES, load_FA_arrays
+
+# Archive of ingested FA data, partitioned by UTC day and tag. Every day is a directory of
+# column files sorted by (ID, Timestamp); a tag's rows of that day are one contiguous
+# partition, cut into row groups of ROW_GROUP rows. Partitions and row groups carry
+# min/max statistics of time, X and Y, so a query on tags, a time range and a bounding box
+# only opens the days it overlaps and only reads the row groups that can match.
+#
+#   archive/manifest.json
+#   archive/2019-11-15/{Timestamp,X,Y,Z,Source}.npy    Source: id of the ingested file
+#   archive/2019-11-15/partitions.npz     tag, start, stop + stats per tag
+#   archive/2019-11-15/row_groups.npz     start, stop + stats per row group
+#
+#   archive = FAArchive('archive')
+#   archive.ingest('FA_20191115T000000UTC.csv')
+#   archive.get_interval(2417246, '2019-11-15 02:05:00', '2019-11-15 02:20:00')
+
+ARCHIVE_VERSION = 2
+ROW_GROUP = 4096
+MS_PER_DAY = 86400000
+COLUMNS = [col for col in FA_CACHE_DTYPES if col != 'ID']
+
+
+def _stats(timestamps, x, y, starts):
+    return {
+        't_min': np.minimum.reduceat(timestamps, starts), 't_max': np.maximum.reduceat(timestamps, starts),
+        'x_min': np.minimum.reduceat(x, starts), 'x_max': np.maximum.reduceat(x, starts),
+        'y_min': np.minimum.reduceat(y, starts), 'y_max': np.maximum.reduceat(y, starts),
+    }
+
+
+# Write one day of (ID, Timestamp)-sorted rows with its partition and row group tables
+def _write_day(day_dir, ids, columns):
+    tmp_dir = day_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for col, values in columns.items():
+        np.save(os.path.join(tmp_dir, col + '.npy'), values)
+
+    tags, starts = np.unique(ids, return_index=True)
+    stops = np.append(starts[1:], len(ids))
+    np.savez(os.path.join(tmp_dir, 'partitions.npz'), tag=tags, start=starts, stop=stops,
+             **_stats(columns['Timestamp'], columns['X'], columns['Y'], starts))
+
+    # row groups never cross a tag boundary
+    group_starts = np.concatenate([np.arange(s, e, ROW_GROUP) for s, e in zip(starts, stops)])
+    group_stops = np.append(group_starts[1:], len(ids))
+    np.savez(os.path.join(tmp_dir, 'row_groups.npz'), start=group_starts, stop=group_stops,
+             **_stats(columns['Timestamp'], columns['X'], columns['Y'], group_starts))
+
+    # swap the finished directory in; the old one is kept aside until the new one is in
+    # place, so there is always a complete day on disk
+    old_dir = day_dir + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(day_dir):
+        os.replace(day_dir, old_dir)
+    os.replace(tmp_dir, day_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return {'rows': len(ids), 'tags': len(tags),
+            't_min': int(columns['Timestamp'].min()), 't_max': int(columns['Timestamp'].max())}
+
+
+class FAArchive:
+    def __init__(self, directory):
+        self.directory = directory
+        self._manifest_file = os.path.join(directory, 'manifest.json')
+        self.manifest = {'version': ARCHIVE_VERSION, 'days': {}, 'sources': {}}
+        if os.path.exists(self._manifest_file):
+            with open(self._manifest_file) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('version') != ARCHIVE_VERSION:
+                raise ValueError(f"{directory} was written by archive version {self.manifest.get('version')}, "
+                                 f"re-ingest into a new directory")
+        self._days = {}    # day -> (partitions, row groups, memory-mapped columns)
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self._manifest_file + '.tmp', self._manifest_file)
+
+    def days(self):
+        return sorted(self.manifest['days'])
+
+    # Add an FA file, or bring it up to date. Rows are split by UTC day and every row keeps
+    # the id of the file it came from, so ingesting a changed file replaces its earlier rows
+    # in each day it touched instead of adding them again. Unchanged files are skipped.
+    #
+    # The file is registered with the union of its old and new days before any day is
+    # rewritten. An interrupted ingest is finished by ingesting the file again: rewriting a
+    # day always drops the file's rows first, so a day that was already swapped in is not
+    # duplicated.
+    def ingest(self, filename):
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        source = self.manifest['sources'].get(path)
+        if source and source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns:
+            return []
+
+        arrays = load_FA_arrays(filename)
+        day_numbers = np.asarray(arrays['Timestamp']) // MS_PER_DAY
+        new_days = {str(np.datetime64(int(d), 'D')): d for d in np.unique(day_numbers)}
+        if source is None:
+            used = [s['id'] for s in self.manifest['sources'].values()]
+            source = {'id': max(used) + 1 if used else 0}
+        affected = sorted(set(source.get('days', [])) | set(new_days))
+        # pending until every day is rewritten: size/mtime never match a file
+        self.manifest['sources'][path] = {'id': source['id'], 'size': None, 'mtime_ns': None, 'days': affected}
+        self._save_manifest()
+
+        for day in affected:
+            ids = np.empty(0, dtype=FA_CACHE_DTYPES['ID'])
+            columns = {col: np.empty(0, dtype=FA_CACHE_DTYPES[col]) for col in COLUMNS}
+            columns['Source'] = np.empty(0, dtype=np.int32)
+            if day in self.manifest['days']:
+                ids, columns = self._read_day(day)
+                keep = columns['Source'] != source['id']
+                ids = ids[keep]
+                columns = {col: values[keep] for col, values in columns.items()}
+            if day in new_days:
+                rows = np.flatnonzero(day_numbers == new_days[day])
+                ids = np.concatenate([ids, np.asarray(arrays['ID'])[rows]])
+                for col in COLUMNS:
+                    columns[col] = np.concatenate([columns[col], np.asarray(arrays[col])[rows]])
+                columns['Source'] = np.concatenate([columns['Source'], np.full(len(rows), source['id'], dtype=np.int32)])
+
+            self._days.pop(day, None)
+            day_dir = os.path.join(self.directory, day)
+            if len(ids) == 0:
+                # the file was the only one with rows of this day
+                shutil.rmtree(day_dir, ignore_errors=True)
+                self.manifest['days'].pop(day, None)
+                self._save_manifest()
+                continue
+            order = np.lexsort((columns['Timestamp'], ids))
+            self.manifest['days'][day] = _write_day(day_dir, ids[order],
+                                                    {col: values[order] for col, values in columns.items()})
+            self._save_manifest()
+
+        self.manifest['sources'][path] = {'id': source['id'], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                          'days': sorted(new_days)}
+        self._save_manifest()
+        return sorted(new_days)
+
+    def _day(self, day):
+        if day not in self._days:
+            day_dir = os.path.join(self.directory, day)
+            if not os.path.exists(day_dir) and os.path.exists(day_dir + '.old'):
+                os.replace(day_dir + '.old', day_dir)    # interrupted between the two renames of _write_day
+            with np.load(os.path.join(day_dir, 'partitions.npz')) as f:
+                partitions = {key: f[key] for key in f.files}
+            with np.load(os.path.join(day_dir, 'row_groups.npz')) as f:
+                row_groups = {key: f[key] for key in f.files}
+            columns = {col: np.load(os.path.join(day_dir, col + '.npy'), mmap_mode='r')
+                       for col in COLUMNS + ['Source']}
+            self._days[day] = (partitions, row_groups, columns)
+        return self._days[day]
+
+    def _read_day(self, day):
+        partitions, _, columns = self._day(day)
+        ids = np.repeat(partitions['tag'], partitions['stop'] - partitions['start'])
+        return ids, {col: np.array(values) for col, values in columns.items()}
+
+    def query(self, tags=None, start_time=None, end_time=None, bbox=None, columns=None):
+        """Rows matching all given predicates, sorted by (ID, Timestamp).
+
+        tags: one ID or a list; start_time/end_time: inclusive bounds as for get_interval;
+        bbox: (x_min, x_max, y_min, y_max) in mm, inclusive. Timestamps are returned as
+        milliseconds, like read_FA_file.
+        """
+        columns = COLUMNS if columns is None else [col for col in columns if col != 'ID']
+        tags = None if tags is None else np.atleast_1d(tags)
+        start_ms = None if start_time is None else pd.to_datetime(start_time).value // 10**6
+        end_ms = None if end_time is None else pd.to_datetime(end_time).value // 10**6
+
+        pieces = []
+        for day, info in sorted(self.manifest['days'].items()):
+            # day pruning
+            if (start_ms is not None and info['t_max'] < start_ms) or (end_ms is not None and info['t_min'] > end_ms):
+                continue
+            partitions, row_groups, data = self._day(day)
+
+            # partition pruning
+            keep = _overlaps(partitions, start_ms, end_ms, bbox)
+            if tags is not None:
+                keep &= np.isin(partitions['tag'], tags)
+            for p in np.flatnonzero(keep):
+                start, stop = partitions['start'][p], partitions['stop'][p]
+                if bbox is None:
+                    # time-sorted partition: binary search instead of reading row groups
+                    lo, hi = _window(data['Timestamp'][start:stop], start_ms, end_ms)
+                    rows = np.arange(start + lo, start + hi)
+                else:
+                    rows = self._row_group_rows(row_groups, data, start, stop, start_ms, end_ms, bbox)
+                if len(rows):
+                    piece = {'ID': np.full(len(rows), partitions['tag'][p])}
+                    piece.update({col: data[col][rows] for col in columns})
+                    pieces.append(piece)
+
+        if not pieces:
+            return pd.DataFrame({col: np.empty(0, dtype=FA_CACHE_DTYPES[col]) for col in ['ID'] + columns})
+        frame = pd.DataFrame({col: np.concatenate([piece[col] for piece in pieces]) for col in ['ID'] + columns})
+        # days come in time order, sort tags in front of them
+        order = np.argsort(frame['ID'].to_numpy(), kind='stable')
+        return frame.iloc[order].reset_index(drop=True)
+
+    # Rows of one partition that pass the predicates, reading only overlapping row groups
+    def _row_group_rows(self, row_groups, data, start, stop, start_ms, end_ms, bbox):
+        first = np.searchsorted(row_groups['start'], start)
+        last = np.searchsorted(row_groups['start'], stop)
+        group_stats = {key: values[first:last] for key, values in row_groups.items()}
+        rows = []
+        for g in np.flatnonzero(_overlaps(group_stats, start_ms, end_ms, bbox)):
+            lo, hi = group_stats['start'][g], group_stats['stop'][g]
+            mask = np.ones(hi - lo, dtype=bool)
+            t = data['Timestamp'][lo:hi]
+            if start_ms is not None:
+                mask &= t >= start_ms
+            if end_ms is not None:
+                mask &= t <= end_ms
+            x, y = data['X'][lo:hi], data['Y'][lo:hi]
+            mask &= (x >= bbox[0]) & (x <= bbox[1]) & (y >= bbox[2]) & (y <= bbox[3])
+            rows.append(lo + np.flatnonzero(mask))
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    # Same result as get_individual on the full data
+    def get_individual(self, individual_id):
+        return self.query(tags=individual_id)
+
+    # Same result as get_interval(get_individual(data, individual_id), start_time, end_time)
+    def get_interval(self, individual_id, start_time, end_time):
+        data = self.query(tags=individual_id, start_time=start_time, end_time=end_time)
+        return data.assign(Timestamp=pd.to_datetime(data['Timestamp'], unit='ms'))
+
+
+# Which entries of a stats table can hold rows inside the time window and bounding box
+def _overlaps(stats, start_ms, end_ms, bbox):
+    keep = np.ones(len(stats['t_min']), dtype=bool)
+    if start_ms is not None:
+        keep &= stats['t_max'] >= start_ms
+    if end_ms is not None:
+        keep &= stats['t_min'] <= end_ms
+    if bbox is not None:
+        x_min, x_max, y_min, y_max = bbox
+        keep &= (stats['x_max'] >= x_min) & (stats['x_min'] <= x_max)
+        keep &= (stats['y_max'] >= y_min) & (stats['y_min'] <= y_max)
+    return keep
+
+
+# [lo, hi) of sorted ms timestamps inside the window, None meaning unbounded
+def _window(timestamps, start_ms, end_ms):
+    lo = 0 if start_ms is None else np.searchsorted(timestamps, start_ms, side='left')
+    hi = len(timestamps) if end_ms is None else np.searchsorted(timestamps, end_ms, side='right')
+    return lo, hi
+
+
+# Check that ingesting the files again after they were touched leaves the archive as it was.
+# Runs on copies of the files and a new archive in a temporary directory, so neither the
+# files (and their column caches) nor any existing archive are changed.
+def check_reingest(filenames):
+    with tempfile.TemporaryDirectory(prefix='fa_reingest_') as scratch:
+        copies = []
+        for filename in filenames:
+            copies.append(os.path.join(scratch, os.path.basename(filename)))
+            shutil.copyfile(filename, copies[-1])
+        archive = FAArchive(os.path.join(scratch, 'archive'))
+        for filename in copies:
+            archive.ingest(filename)
+        before = archive.query()
+        for filename in copies:
+            os.utime(filename, ns=(os.stat(filename).st_atime_ns, os.stat(filename).st_mtime_ns + 10**9))
+            archive.ingest(filename)
+        after = FAArchive(os.path.join(scratch, 'archive')).query()
+    assert len(after) == len(before), f"re-ingest changed the row count: {len(before)} -> {len(after)}"
+    pd.testing.assert_frame_equal(before, after)
+    return len(after)
+
+
+if __name__ == "__main__":
+
+    # usage: python fa_archive.py ARCHIVE_DIR FA_1.csv [FA_2.csv ...]
+    #        python fa_archive.py --check FA_1.csv [FA_2.csv ...]    (works on temporary copies)
+    if sys.argv[1] == '--check':
+        print(f"re-ingest is idempotent: {check_reingest(sys.argv[2:])} rows")
+    else:
+        archive = FAArchive(sys.argv[1])
+        for filename in sys.argv[2:]:
+            print(filename, archive.ingest(filename))
@@ -0,0 +1,259 @@
+import numpy as np
+import pandas as pd
+from spikes_medfilt_v2 import _sorted_by_tag_and_time, _tag_starts, _timestamps_as_ms
+
+
+# Gap detection and filling for the 1 Hz RTLS positions. Ren et al. report 2-58% missing
+# samples per cow; without filling, calculate_velocity divides across multi-minute holes
+# and the median filter treats samples on both sides of a hole as neighbours.
+# Everything works on the whole herd at once ((ID, Timestamp)-sorted rows) and should run
+# before spike removal.
+
+# Gap categories by the time between two consecutive samples of a tag:
+#   '1s'     - one or a few 1 s samples missing (shorter than 5 s)
+#   '5s'     - at least 5 s missing
+#   '10min'  - at least 10 min missing, marked but never filled
+GAP_SHORT_S = 5.0
+GAP_LONG_S = 600.0
+FILL_METHODS = ('linear', 'spline', 'hermite_cv', 'kalman')
+# Samples on either side of a gap that the 'kalman' bridge filters
+KALMAN_HISTORY = 10
+# Prior spread of the velocity before a gap (a cow does not walk faster than ~2 m/s); the
+# filter after the gap starts without a prior, so the prior is counted once
+KALMAN_VELOCITY_PRIOR_MM_S = 2000.0
+DIFFUSE_MM_S = 1e6
+
+
+# Category of the gap in front of every sample ('' when the sample follows on time)
+def _gap_categories(gap_s, sample_interval_s):
+    category = np.full(len(gap_s), '', dtype=object)
+    category[gap_s > 1.5 * sample_interval_s] = '1s'
+    category[gap_s >= GAP_SHORT_S] = '5s'
+    category[gap_s >= GAP_LONG_S] = '10min'
+    return category
+
+
+# One row per gap: tag, last sample before, first sample after, length and category
+def detect_gaps(data, sample_interval_s=1.0):
+    data = _sorted_by_tag_and_time(data)
+    ids = data['ID'].to_numpy()
+    ts = _timestamps_as_ms(data['Timestamp'])
+    starts = _tag_starts(ids)
+
+    gap_s = np.zeros(len(ts))
+    gap_s[1:] = np.diff(ts) / 1000.0
+    gap_s[starts] = 0.0
+    category = _gap_categories(gap_s, sample_interval_s)
+    after = np.flatnonzero(category != '')
+
+    return pd.DataFrame({
+        'ID': ids[after],
+        'Start': ts[after - 1],
+        'End': ts[after],
+        'Gap_s': gap_s[after],
+        'Missing': np.rint(gap_s[after] / sample_interval_s).astype(np.int64) - 1,
+        'Category': category[after],
+    })
+
+
+# Velocity at the start and the end of every gap, from the samples just outside it
+def _outside_velocity(values, ts, before, after, n, same_tag_before, same_tag_after):
+    v0 = np.zeros(len(before))
+    v1 = np.zeros(len(before))
+    prev = before - 1
+    nxt = np.minimum(after + 1, n - 1)
+    ok = same_tag_before & (prev >= 0)
+    v0[ok] = (values[before[ok]] - values[prev[ok]]) / (ts[before[ok]] - ts[prev[ok]])
+    ok = same_tag_after & (after + 1 < n)
+    v1[ok] = (values[nxt[ok]] - values[after[ok]]) / (ts[nxt[ok]] - ts[after[ok]])
+    return v0, v1
+
+
+# Cubic Hermite curve between (t0, p0, m0) and (t1, p1, m1), evaluated at fraction s
+def _hermite(p0, p1, m0, m1, duration, s):
+    s2 = s * s
+    s3 = s2 * s
+    return ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * duration * m0
+            + (-2 * s3 + 3 * s2) * p1 + (s3 - s2) * duration * m1)
+
+
+# Constant-velocity model for states (position, velocity) over time steps dt (seconds):
+# transition matrices F and process noise Q of white acceleration with spectral density q
+def _cv_transition(dt):
+    F = np.zeros((len(dt), 2, 2))
+    F[:, 0, 0] = F[:, 1, 1] = 1.0
+    F[:, 0, 1] = dt
+    return F
+
+
+def _cv_noise(dt, q):
+    Q = np.empty((len(dt), 2, 2))
+    Q[:, 0, 0] = q * dt ** 3 / 3
+    Q[:, 0, 1] = Q[:, 1, 0] = q * dt ** 2 / 2
+    Q[:, 1, 1] = q * dt
+    return Q
+
+
+# Predict states (m, P) forward by dt
+def _cv_predict(m, P, dt, q):
+    F = _cv_transition(dt)
+    return np.einsum('nij,nj->ni', F, m), F @ P @ F.transpose(0, 2, 1) + _cv_noise(dt, q)
+
+
+# Kalman filter of many short position tracks at once. times/values are (tracks, samples),
+# oldest first, and only entries where `valid` is set are used; every track has at least one.
+# Returns the filtered state (position, velocity), its covariance and the time of the last sample.
+def _cv_filter(times, values, valid, r, q, velocity_prior):
+    n = len(times)
+    m = np.zeros((n, 2))
+    P = np.zeros((n, 2, 2))
+    last = np.zeros(n)
+    started = np.zeros(n, dtype=bool)
+    for j in range(times.shape[1]):
+        # the first sample of a track sets its position, the velocity is only bounded
+        first = valid[:, j] & ~started
+        m[first] = np.column_stack([values[first, j], np.zeros(first.sum())])
+        P[first] = np.diag([r, velocity_prior ** 2])
+        step = valid[:, j] & started
+        if step.any():
+            mp, Pp = _cv_predict(m[step], P[step], times[step, j] - last[step], q)
+            gain = Pp[:, :, 0] / (Pp[:, 0, 0] + r)[:, None]
+            m[step] = mp + gain * (values[step, j] - mp[:, 0])[:, None]
+            P[step] = Pp - gain[:, :, None] * Pp[:, None, 0, :]
+        last[valid[:, j]] = times[valid[:, j], j]
+        started |= valid[:, j]
+    return m, P, last
+
+
+# Smoothed positions at new_t (seconds) inside gaps between rows before[g] and after[g]: the
+# samples before a gap are filtered forward, the samples after it backward in time, and the
+# two estimates are combined at every filled time (two-filter form of the RTS smoother)
+def _kalman_bridge(values, t, before, after, first_row, last_row, gap_of_row, new_t, r, q):
+    n = len(values)
+    history = np.arange(KALMAN_HISTORY)[::-1]
+    rows = before[:, None] - history
+    valid = rows >= first_row[before][:, None]
+    rows = np.clip(rows, 0, n - 1)
+    m_f, P_f, t_f = _cv_filter(t[rows], values[rows], valid, r, q, KALMAN_VELOCITY_PRIOR_MM_S)
+    # backward filter: reversed time, so its velocity has the opposite sign
+    rows = after[:, None] + history
+    valid = rows <= last_row[after][:, None]
+    rows = np.clip(rows, 0, n - 1)
+    m_b, P_b, t_b = _cv_filter(-t[rows], values[rows], valid, r, q, DIFFUSE_MM_S)
+
+    a, A = _cv_predict(m_f[gap_of_row], P_f[gap_of_row], new_t - t_f[gap_of_row], q)
+    b, B = _cv_predict(m_b[gap_of_row], P_b[gap_of_row], -t_b[gap_of_row] - new_t, q)
+    b[:, 1] = -b[:, 1]
+    B[:, 0, 1] = -B[:, 0, 1]
+    B[:, 1, 0] = -B[:, 1, 0]
+    A_inv, B_inv = np.linalg.inv(A), np.linalg.inv(B)
+    information = np.einsum('nij,nj->ni', A_inv, a) + np.einsum('nij,nj->ni', B_inv, b)
+    return np.einsum('nij,nj->ni', np.linalg.inv(A_inv + B_inv), information)[:, 0]
+
+
+# Fill gaps shorter than max_fill_s with interpolated samples on the sample_interval_s grid.
+#   'linear' - straight line between the samples around the gap
+#   'spline' - cubic Hermite (Catmull-Rom) curve using the samples on either side
+#   'hermite_cv' - cubic Hermite bridge whose end velocities are those measured just
+#              outside the gap, blended towards the straight-line velocity across the gap
+#              as it grows (time constant velocity_decay_s); a heuristic, not a Kalman
+#              smoother
+#   'kalman' - constant-velocity Kalman smoother over the KALMAN_HISTORY samples on either
+#              side of the gap, with measurement noise measurement_noise_mm and white
+#              acceleration noise acceleration_noise_mm_s2 (per sqrt(s)); per axis
+# Added rows have Interpolated=True; every row gets the category of the gap in front of
+# it, so long gaps stay visible ('10min') without being filled.
+def fill_gaps(data, method='linear', sample_interval_s=1.0, max_fill_s=GAP_LONG_S,
+              columns=('X', 'Y', 'Z'), velocity_decay_s=30.0, measurement_noise_mm=50.0,
+              acceleration_noise_mm_s2=100.0):
+    if method not in FILL_METHODS:
+        raise ValueError(f"Unknown fill method '{method}', expected one of {FILL_METHODS}.")
+    data = _sorted_by_tag_and_time(data).reset_index(drop=True)
+    ids = data['ID'].to_numpy()
+    ts = _timestamps_as_ms(data['Timestamp'])
+    starts = _tag_starts(ids)
+    n = len(ts)
+
+    gap_s = np.zeros(n)
+    gap_s[1:] = np.diff(ts) / 1000.0
+    gap_s[starts] = 0.0
+    data['Gap'] = _gap_categories(gap_s, sample_interval_s)
+    data['Interpolated'] = False
+
+    # samples missing in front of every row, only for gaps that are filled
+    missing = np.rint(gap_s / sample_interval_s).astype(np.int64) - 1
+    missing[(data['Gap'].to_numpy() == '') | (gap_s >= max_fill_s)] = 0
+    missing = np.maximum(missing, 0)
+    after = np.flatnonzero(missing)
+    if len(after) == 0:
+        return data
+    before = after - 1
+    count = missing[after]
+
+    # new samples: gap g gets count[g] samples at fractions 1/(count+1) ... count/(count+1)
+    gap_of_row = np.repeat(np.arange(len(after)), count)
+    step = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + 1
+    t0 = ts[before][gap_of_row]
+    t1 = ts[after][gap_of_row]
+    new_ts = t0 + np.rint(step * (t1 - t0) / (count[gap_of_row] + 1)).astype(np.int64)
+    s = (new_ts - t0) / (t1 - t0)
+    duration = (t1 - t0).astype(np.float64)
+
+    same_tag_before = ~starts[before]
+    same_tag_after = np.r_[~starts[1:], False][after]
+    new_rows = {'ID': ids[after][gap_of_row]}
+    for col in columns:
+        values = data[col].to_numpy(dtype=np.float64)
+        p0 = values[before][gap_of_row]
+        p1 = values[after][gap_of_row]
+        if method == 'linear':
+            new_rows[col] = p0 + (p1 - p0) * s
+            continue
+        if method == 'kalman':
+            first_row = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+            last_row = np.r_[np.flatnonzero(starts)[1:] - 1, n - 1][np.cumsum(starts) - 1]
+            new_rows[col] = _kalman_bridge(values, ts / 1000.0, before, after, first_row, last_row, gap_of_row,
+                                           new_ts / 1000.0, measurement_noise_mm ** 2, acceleration_noise_mm_s2 ** 2)
+            continue
+        tsf = ts.astype(np.float64)
+        if method == 'spline':
+            # Catmull-Rom tangents from the samples one further out on each side
+            prev = np.where(same_tag_before, before - 1, before)
+            nxt = np.where(same_tag_after, np.minimum(after + 1, n - 1), after)
+            m0 = (values[after] - values[prev]) / np.maximum(tsf[after] - tsf[prev], 1.0)
+            m1 = (values[nxt] - values[before]) / np.maximum(tsf[nxt] - tsf[before], 1.0)
+        else:
+            v0, v1 = _outside_velocity(values, tsf, before, after, n, same_tag_before, same_tag_after)
+            decay = np.exp(-(tsf[after] - tsf[before]) / 1000.0 / velocity_decay_s)
+            secant = (values[after] - values[before]) / (tsf[after] - tsf[before])
+            m0 = decay * v0 + (1 - decay) * secant
+            m1 = decay * v1 + (1 - decay) * secant
+        new_rows[col] = _hermite(p0, p1, m0[gap_of_row], m1[gap_of_row], duration, s)
+
+    filled = pd.DataFrame(new_rows)
+    for col in columns:
+        if np.issubdtype(data[col].dtype, np.integer):
+            filled[col] = np.rint(filled[col]).astype(data[col].dtype)
+    if pd.api.types.is_datetime64_any_dtype(data['Timestamp']):
+        filled['Timestamp'] = pd.to_datetime(new_ts, unit='ms').astype(data['Timestamp'].dtype)
+    else:
+        filled['Timestamp'] = new_ts.astype(data['Timestamp'].dtype)
+    filled['Gap'] = data['Gap'].to_numpy()[after][gap_of_row]
+    filled['Interpolated'] = True
+
+    # merge: every filled sample goes right before the row that ends its gap
+    out = pd.concat([data, filled], ignore_index=True)
+    position = np.r_[np.arange(n, dtype=np.float64), after[gap_of_row] - 1 + step / (count[gap_of_row] + 1)]
+    return out.iloc[np.argsort(position, kind='stable')].reset_index(drop=True)
+
+
+# Short summary of missing data per tag, as in the Ren et al. tables
+def gap_summary(data, sample_interval_s=1.0):
+    gaps = detect_gaps(data, sample_interval_s)
+    observed = data.groupby('ID').size()
+    missing = gaps.groupby('ID')['Missing'].sum().reindex(observed.index, fill_value=0)
+    per_category = gaps.pivot_table(index='ID', columns='Category', values='Missing',
+                                    aggfunc='size', fill_value=0).reindex(observed.index, fill_value=0)
+    summary = pd.DataFrame({'Observed': observed, 'Missing': missing})
+    summary['Missing_pct'] = 100.0 * summary['Missing'] / (summary['Observed'] + summary['Missing'])
+    return summary.join(per_category.add_prefix('Gaps_'))
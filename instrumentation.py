@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import cProfile
+import functools
+import tracemalloc
+
+
+# Per-stage instrumentation for the pipeline functions. Every decorated function records
+# its wall time, rows in and out, bytes read and (optionally) peak traced memory as one
+# JSON line in a trace file. One stage can also be run under cProfile; the .prof files
+# open in snakeviz or convert to flame graphs with flameprof.
+#
+# Off by default; when off a decorated call costs one flag check. Turn it on with
+#   SPIKYCOW_TRACE=trace.jsonl           trace file (enables instrumentation)
+#   SPIKYCOW_TRACE_MEMORY=1              also record peak memory (tracemalloc, slower)
+#   SPIKYCOW_PROFILE=remove_herd_spikes  cProfile this stage
+# or from code with enable_instrumentation(...).
+
+_config = {
+    'enabled': False,
+    'trace_file': None,
+    'memory': False,
+    'profile_stage': None,
+    'profile_dir': '.',
+}
+_depth = [0]
+# one entry per traced stage in progress: the highest peak it reached before tracemalloc's
+# peak was last reset for a nested stage, or inside a finished nested stage
+_peaks = []
+_profile_count = {}
+
+
+def enable_instrumentation(trace_file='trace.jsonl', memory=False, profile_stage=None, profile_dir=None):
+    _config.update(enabled=True, trace_file=trace_file, memory=memory, profile_stage=profile_stage,
+                   profile_dir=profile_dir or os.path.dirname(os.path.abspath(trace_file)))
+
+
+def disable_instrumentation():
+    _config['enabled'] = False
+
+
+def instrumentation_enabled():
+    return _config['enabled']
+
+
+# Rows of a DataFrame/Series/array/FAIndex, or of the first element of a returned tuple
+def _rows(value):
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if hasattr(value, 'shape') and len(getattr(value, 'shape')):
+        return int(value.shape[0])
+    if hasattr(value, '__len__') and not isinstance(value, (str, bytes, dict)):
+        return len(value)
+    return None
+
+
+# Bytes this process has read so far through read() calls (Linux /proc/self/io, None
+# elsewhere). Pages of memory-mapped cache files are not counted.
+def _bytes_read():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _write(record):
+    with open(_config['trace_file'], 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+# Decorator for a pipeline stage
+def instrumented(stage):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _config['enabled']:
+                return func(*args, **kwargs)
+            return _run_instrumented(stage, func, args, kwargs)
+        return wrapper
+    return decorate
+
+
+def _run_instrumented(stage, func, args, kwargs):
+    rows_in = _rows(args[0]) if args else None
+    bytes_before = _bytes_read()
+    # the outermost traced stage owns tracemalloc; a nested stage folds the peak so far into
+    # its parent's running maximum before resetting it, and hands its own peak back when done
+    start_memory = _config['memory'] and not tracemalloc.is_tracing()
+    if start_memory:
+        tracemalloc.start()
+        _peaks.append(0)
+    elif _config['memory']:
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        _peaks.append(0)
+    profiler = cProfile.Profile() if stage == _config['profile_stage'] else None
+
+    _depth[0] += 1
+    start = time.perf_counter()
+    started_at = time.time()
+    try:
+        if profiler is not None:
+            result = profiler.runcall(func, *args, **kwargs)
+        else:
+            result = func(*args, **kwargs)
+    except BaseException:
+        if _config['memory'] and _peaks:
+            _peaks.pop()
+            if start_memory:
+                tracemalloc.stop()
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        _depth[0] -= 1
+
+    record = {
+        'stage': stage,
+        'start': started_at,
+        'seconds': seconds,
+        'depth': _depth[0],
+        'rows_in': rows_in,
+        'rows_out': _rows(result),
+        'pid': os.getpid(),
+    }
+    bytes_after = _bytes_read()
+    if bytes_before is not None and bytes_after is not None:
+        record['bytes_read'] = bytes_after - bytes_before
+    if _config['memory'] and _peaks:
+        peak = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+        record['peak_mb'] = peak / 2**20
+        if start_memory:
+            tracemalloc.stop()
+        elif _peaks:
+            _peaks[-1] = max(_peaks[-1], peak)
+    if profiler is not None:
+        count = _profile_count[stage] = _profile_count.get(stage, 0) + 1
+        profile_file = os.path.join(_config['profile_dir'], f"profile_{stage}_{os.getpid()}_{count}.prof")
+        profiler.dump_stats(profile_file)
+        record['profile'] = profile_file
+    _write(record)
+    return result
+
+
+# Totals per stage from a trace file: calls, total/max seconds, rows and peak memory
+def summarize_trace(trace_file):
+    summary = {}
+    with open(trace_file) as f:
+        for line in f:
+            record = json.loads(line)
+            s = summary.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                     'rows_in': 0, 'rows_out': 0, 'bytes_read': 0, 'peak_mb': None})
+            s['calls'] += 1
+            s['seconds'] += record['seconds']
+            s['max_seconds'] = max(s['max_seconds'], record['seconds'])
+            s['rows_in'] += record['rows_in'] or 0
+            s['rows_out'] += record['rows_out'] or 0
+            s['bytes_read'] += record.get('bytes_read') or 0
+            if record.get('peak_mb') is not None:
+                s['peak_mb'] = max(s['peak_mb'] or 0.0, record['peak_mb'])
+    return summary
+
+
+def print_trace_summary(trace_file):
+    print(f"{'stage':<36} {'calls':>6} {'seconds':>10} {'max s':>9} {'rows in':>12} {'rows out':>12} {'MB read':>9} {'peak MB':>9}")
+    for stage, s in sorted(summarize_trace(trace_file).items(), key=lambda item: -item[1]['seconds']):
+        peak = '' if s['peak_mb'] is None else f"{s['peak_mb']:.1f}"
+        print(f"{stage:<36} {s['calls']:>6} {s['seconds']:>10.3f} {s['max_seconds']:>9.3f} "
+              f"{s['rows_in']:>12} {s['rows_out']:>12} {s['bytes_read'] / 2**20:>9.1f} {peak:>9}")
+
+
+# Configure from the environment at import time
+if os.environ.get('SPIKYCOW_TRACE'):
+    enable_instrumentation(os.environ['SPIKYCOW_TRACE'],
+                           memory=os.environ.get('SPIKYCOW_TRACE_MEMORY', '') not in ('', '0'),
+                           profile_stage=os.environ.get('SPIKYCOW_PROFILE') or None)
+
+
+if __name__ == "__main__":
+
+    # usage: python instrumentation.py TRACE_FILE
+    import sys
+    print_trace_summary(sys.argv[1])
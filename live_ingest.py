@@ -0,0 +1,193 @@
+import sys
+import math
+import time
+from collections import deque
+import numpy as np
+from rolling_median import RollingMedian, window_extent
+
+
+# Live spike removal: rows arrive one at a time (from a growing FA file or a pipe/socket),
+# every tag keeps a ring buffer of its last kernel_size samples and running medians of X
+# and Y, and each sample is emitted as soon as kernel_size//2 later samples of its tag
+# have arrived. The threshold and kernel size are those of remove_spikes_and_identify;
+# with mode='zero' and a final flush() the cleaned Y equals its batch output.
+
+LIVE_MODES = ('zero', 'nearest')
+
+
+# Parse one FA CSV line: Column1, ID, Column3, Timestamp, X, Y, Z
+def parse_FA_line(line):
+    fields = line.split(',')
+    return int(fields[1]), int(fields[3]), float(fields[4]), float(fields[5])
+
+
+# Follow a growing FA file like `tail -f`, yielding (ID, Timestamp, X, Y) rows.
+# Partial lines are kept until the writer finishes them. Stops after `idle_timeout`
+# seconds without new data (None: follow forever).
+def tail_FA_file(filename, poll_interval=0.1, from_start=True, idle_timeout=None):
+    with open(filename) as f:
+        if not from_start:
+            f.seek(0, 2)
+        partial = ''
+        idle = 0.0
+        while True:
+            line = f.readline()
+            if not line:
+                if idle_timeout is not None and idle >= idle_timeout:
+                    return
+                time.sleep(poll_interval)
+                idle += poll_interval
+                continue
+            idle = 0.0
+            partial += line
+            if not partial.endswith('\n'):
+                continue
+            if partial.strip():
+                yield parse_FA_line(partial)
+            partial = ''
+
+
+# Rows from any line-based stream: sys.stdin, a named pipe or socket.makefile()
+def read_FA_stream(stream):
+    for line in stream:
+        if line.strip():
+            yield parse_FA_line(line)
+
+
+class _TagState:
+    def __init__(self, kernel_size):
+        self.buffer = deque(maxlen=kernel_size)    # (Timestamp, X, Y), None for padding
+        self.median_x = RollingMedian(kernel_size)
+        self.median_y = RollingMedian(kernel_size)
+        self.last = None                           # last emitted (Timestamp, X, Y), cleaned
+
+
+class LiveSpikeFilter:
+    def __init__(self, spike_threshold=200, kernel_size=41, mode='nearest'):
+        if mode not in LIVE_MODES:
+            raise ValueError(f"Unknown live edge mode '{mode}', expected one of {LIVE_MODES}.")
+        self.spike_threshold = spike_threshold
+        self.kernel_size = kernel_size
+        self.mode = mode
+        self.left, self.right = window_extent(kernel_size)
+        self.tags = {}
+
+    # Start a tag with `left` padding samples, as the batch filter does at the signal start
+    def _new_tag(self, x, y):
+        state = _TagState(self.kernel_size)
+        pad_x, pad_y = (0.0, 0.0) if self.mode == 'zero' else (x, y)
+        for _ in range(self.left):
+            state.buffer.append(None)
+            state.median_x.push(pad_x)
+            state.median_y.push(pad_y)
+        return state
+
+    # Output record for the sample in the middle of a full window
+    def _emit(self, tag, state):
+        centre = state.buffer[self.left]
+        if len(state.buffer) < self.kernel_size or centre is None:
+            return None
+        timestamp, x, y = centre
+        median_x, median_y = state.median_x.median(), state.median_y.median()
+        spike_x = abs(x - median_x) > self.spike_threshold
+        spike_y = abs(y - median_y) > self.spike_threshold
+        fixed_x = median_x if spike_x else x
+        fixed_y = median_y if spike_y else y
+
+        velocity = 0.0
+        if state.last is not None and timestamp > state.last[0]:
+            velocity = math.hypot(fixed_x - state.last[1], fixed_y - state.last[2]) / ((timestamp - state.last[0]) / 1000.0)
+        state.last = (timestamp, fixed_x, fixed_y)
+        return {'ID': tag, 'Timestamp': timestamp, 'X': fixed_x, 'Y': fixed_y,
+                'Velocity': velocity, 'Spike': spike_x or spike_y, 'Spike_Y': spike_y}
+
+    # Feed one sample; returns the cleaned record of the sample kernel_size//2 steps back, or None
+    def push(self, tag, timestamp, x, y):
+        state = self.tags.get(tag)
+        if state is None:
+            state = self.tags[tag] = self._new_tag(x, y)
+        state.buffer.append((timestamp, x, y))
+        state.median_x.push(x)
+        state.median_y.push(y)
+        return self._emit(tag, state)
+
+    # Emit the samples still waiting for later samples, padding the end of every tag
+    def flush(self):
+        records = []
+        for tag, state in self.tags.items():
+            last = next((s for s in reversed(state.buffer) if s is not None), None)
+            if last is None:
+                continue
+            pad_x, pad_y = (0.0, 0.0) if self.mode == 'zero' else (last[1], last[2])
+            for _ in range(self.right):
+                state.buffer.append(None)
+                state.median_x.push(pad_x)
+                state.median_y.push(pad_y)
+                record = self._emit(tag, state)
+                if record is not None:
+                    records.append(record)
+        return records
+
+
+# Feed rows from a source into the filter and hand every emitted record to `sink`
+def run_live(rows, live_filter, sink=print):
+    for tag, timestamp, x, y in rows:
+        record = live_filter.push(tag, timestamp, x, y)
+        if record is not None:
+            sink(record)
+
+
+# Latency and throughput of the live filter for n_tags tags sending at rate_hz,
+# replayed as fast as possible. The headroom is the throughput divided by the
+# rate the barn actually produces (n_tags * rate_hz samples per second).
+def benchmark_live(n_tags=200, rate_hz=1, seconds=600, spike_threshold=200, kernel_size=41, seed=0):
+    rng = np.random.default_rng(seed)
+    n_steps = int(seconds * rate_hz)
+    tags = 2417000 + np.arange(n_tags)
+    xs = np.cumsum(rng.normal(0, 100, (n_steps, n_tags)), axis=0) + 1500
+    ys = np.cumsum(rng.normal(0, 100, (n_steps, n_tags)), axis=0) + 10000
+    spikes = rng.random((n_steps, n_tags)) < 0.01
+    ys[spikes] += 3000
+
+    live_filter = LiveSpikeFilter(spike_threshold, kernel_size)
+    latencies = np.empty(n_steps * n_tags)
+    emitted = 0
+    i = 0
+    start = time.perf_counter()
+    for step in range(n_steps):
+        timestamp = 1573776000000 + int(step * 1000 / rate_hz)
+        for j in range(n_tags):
+            t0 = time.perf_counter()
+            if live_filter.push(tags[j], timestamp, xs[step, j], ys[step, j]) is not None:
+                emitted += 1
+            latencies[i] = time.perf_counter() - t0
+            i += 1
+    elapsed = time.perf_counter() - start
+
+    throughput = len(latencies) / elapsed
+    result = {
+        'samples': len(latencies),
+        'emitted': emitted,
+        'throughput_per_s': throughput,
+        'latency_p50_us': float(np.percentile(latencies, 50) * 1e6),
+        'latency_p99_us': float(np.percentile(latencies, 99) * 1e6),
+        'output_delay_samples': kernel_size // 2,
+        'output_delay_s': (kernel_size // 2) / rate_hz,
+        'headroom': throughput / (n_tags * rate_hz),
+    }
+    for key, value in result.items():
+        print(f"{key}: {value}")
+    return result
+
+
+if __name__ == "__main__":
+
+    # usage: python live_ingest.py FA_file.csv   (follow a growing file)
+    #        python live_ingest.py -             (read rows from stdin / a pipe)
+    #        python live_ingest.py --benchmark
+    if sys.argv[1] == '--benchmark':
+        benchmark_live()
+    elif sys.argv[1] == '-':
+        run_live(read_FA_stream(sys.stdin), LiveSpikeFilter())
+    else:
+        run_live(tail_FA_file(sys.argv[1]), LiveSpikeFilter())
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from spikes_medfilt_v2 import _sorted_by_tag_and_time, _segmented_diff, _tag_starts, _timestamps_as_ms
+
+
+# Barn occupancy: time every cow spends in every cell of a grid over the barn, per hour,
+# as in the cubicle-occupancy study. Cleaned X/Y samples are binned into an nx x ny grid
+# and weighted by their TimeDiff. Only the per (tag, hour, cell) totals are kept, so days
+# can be added one after another without holding the raw rows.
+
+MS_PER_HOUR = 3600 * 1000
+
+
+class OccupancyGrid:
+    def __init__(self, x_min, x_max, y_min, y_max, nx=20, ny=17, max_dwell_s=10.0):
+        self.x_min, self.x_max = x_min, x_max
+        self.y_min, self.y_max = y_min, y_max
+        self.nx, self.ny = nx, ny
+        self.max_dwell_s = max_dwell_s    # longer TimeDiffs are gaps, not dwelling
+        self.outside = 0                  # samples that fell outside the grid
+        self.table = pd.Series(dtype=np.float64, index=pd.MultiIndex.from_arrays(
+            [[], [], []], names=['ID', 'Hour', 'Cell']), name='Dwell_s')
+
+    # Flat cell index (row-major, y then x) of every sample, -1 outside the grid
+    def cells(self, x, y):
+        ix = np.floor((np.asarray(x, dtype=np.float64) - self.x_min) / (self.x_max - self.x_min) * self.nx)
+        iy = np.floor((np.asarray(y, dtype=np.float64) - self.y_min) / (self.y_max - self.y_min) * self.ny)
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        return np.where(inside, iy * self.nx + ix, -1).astype(np.int64)
+
+    # Add a batch of samples (e.g. one day). Uses X_fixed/Y_fixed style columns through
+    # x_col/y_col, and TimeDiff when present (it is computed per tag otherwise).
+    def update(self, data, x_col='X', y_col='Y'):
+        data = _sorted_by_tag_and_time(data)
+        ids = data['ID'].to_numpy()
+        ts = _timestamps_as_ms(data['Timestamp'])
+        if 'TimeDiff' in data.columns:
+            dwell = data['TimeDiff'].to_numpy(dtype=np.float64)
+        else:
+            dwell = _segmented_diff(ts, _tag_starts(ids)) / 1000.0
+        dwell = np.where(np.isfinite(dwell) & (dwell <= self.max_dwell_s), dwell, 0.0)
+
+        cell = self.cells(data[x_col], data[y_col])
+        inside = cell >= 0
+        self.outside += int((~inside).sum())
+
+        # bincount over the (tag, hour, cell) combinations present in this batch
+        tag_codes, tags = pd.factorize(ids[inside])
+        hours = ts[inside] // MS_PER_HOUR
+        hour0 = hours.min() if len(hours) else 0
+        n_cells = self.nx * self.ny
+        n_hours = (hours.max() - hour0 + 1) if len(hours) else 1
+        key = (tag_codes * n_hours + (hours - hour0)) * n_cells + cell[inside]
+        keys, inverse = np.unique(key, return_inverse=True)
+        totals = np.bincount(inverse, weights=dwell[inside])
+
+        batch = pd.Series(totals, name='Dwell_s', index=pd.MultiIndex.from_arrays([
+            np.asarray(tags)[keys // (n_hours * n_cells)],
+            hour0 + (keys // n_cells) % n_hours,
+            keys % n_cells,
+        ], names=['ID', 'Hour', 'Cell']))
+        self.table = self.table.add(batch, fill_value=0.0) if len(self.table) else batch
+        return self
+
+    # Dwell seconds per cell as a (ny, nx) array, for one tag or the herd and an hour range
+    def heatmap(self, individual_id=None, start_time=None, end_time=None):
+        table = self.table
+        if individual_id is not None:
+            table = table[table.index.get_level_values('ID') == individual_id]
+        hours = table.index.get_level_values('Hour')
+        if start_time is not None:
+            table = table[hours >= pd.to_datetime(start_time).value // 10**6 // MS_PER_HOUR]
+            hours = table.index.get_level_values('Hour')
+        if end_time is not None:
+            table = table[hours <= pd.to_datetime(end_time).value // 10**6 // MS_PER_HOUR]
+        cells = table.index.get_level_values('Cell').to_numpy()
+        grid = np.bincount(cells, weights=table.to_numpy(), minlength=self.nx * self.ny)
+        return grid.reshape(self.ny, self.nx)
+
+    # Long table with readable hour and cell coordinates
+    def to_frame(self):
+        frame = self.table.reset_index()
+        frame['Hour'] = pd.to_datetime(frame['Hour'] * MS_PER_HOUR, unit='ms')
+        frame['Cell_x'] = frame['Cell'] % self.nx
+        frame['Cell_y'] = frame['Cell'] // self.nx
+        return frame
+
+    # Keep the accumulated totals between runs so new days only add to them
+    def save(self, filename):
+        frame = self.table.reset_index()
+        np.savez(filename, ID=frame['ID'].to_numpy(), Hour=frame['Hour'].to_numpy(),
+                 Cell=frame['Cell'].to_numpy(), Dwell_s=frame['Dwell_s'].to_numpy(),
+                 grid=np.array([self.x_min, self.x_max, self.y_min, self.y_max, self.nx, self.ny,
+                                self.max_dwell_s, self.outside], dtype=np.float64))
+
+    @classmethod
+    def load(cls, filename):
+        saved = np.load(filename)
+        x_min, x_max, y_min, y_max, nx, ny, max_dwell_s, outside = saved['grid']
+        grid = cls(x_min, x_max, y_min, y_max, int(nx), int(ny), max_dwell_s)
+        grid.outside = int(outside)
+        grid.table = pd.Series(saved['Dwell_s'], name='Dwell_s', index=pd.MultiIndex.from_arrays(
+            [saved['ID'], saved['Hour'], saved['Cell']], names=['ID', 'Hour', 'Cell']))
+        return grid
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from spikes_medfilt_v2 import (FA_CACHE_DTYPES, fa_cache_path, load_FA_arrays, calculate_herd_kinematics,
+                               remove_herd_spikes, clean_herd_positions)
+from quantile_sketch import KinematicsSketches
+from gap_filling import fill_gaps
+
+
+# Process-pool version of the herd pipeline. Work is split two ways:
+#   - by file: building the column cache and the per-tag ranges and row counts of every FA file,
+#   - by tag shard: kinematics and spike removal on contiguous groups of tags.
+# Tags are continuous across days, so a shard covers its tags over all files and the
+# result matches the in-memory herd path. The parent only sees per-file tag tables. Next to
+# each file's column cache a row order grouped by tag is kept, so a worker gathers just the
+# rows of its own tags from the memory-mapped columns and sorts only its shard; no process
+# holds or sorts all rows. Shards write their columns to shared files that the parent joins
+# in shard order, so the merged output is the same for any number of workers (and gap filling
+# may add rows to a shard). Every shard also
+# returns per-(tag, day) quantile sketches of velocity and acceleration; the thresholds
+# come from their merge, so no full column has to be sorted.
+
+INPUT_COLUMNS = list(FA_CACHE_DTYPES)
+OUTPUT_COLUMNS = {
+    'TimeDiff': np.float64,
+    'Velocity': np.float64,
+    'Acceleration': np.float64,
+    'Theta': np.float64,
+    'Cosine': np.float64,
+    'Theta_diff': np.float64,
+    'Angular_velocity': np.float64,
+    'Y_fixed': np.float64,
+    'Spike': np.bool_,
+}
+
+
+# Shared column arrays are .npy files in a RAM-backed directory (/dev/shm where it
+# exists) that every process memory-maps, so workers only receive file names
+def _shared_dir():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(prefix='fa_shared_', dir=base)
+
+
+def _shard_path(directory, shard, col):
+    return os.path.join(directory, f'{shard}_{col}.npy')
+
+
+# Rows of an FA file grouped by tag (file order within a tag), stored next to its column
+# cache and rebuilt when the cache was built from another version of the CSV. Returns
+# (tags, offsets, memory-mapped row order); tag i has rows order[offsets[i]:offsets[i + 1]].
+def _tag_order(filename):
+    ids = load_FA_arrays(filename, ['ID'])['ID']    # builds or refreshes the cache
+    cache_path = fa_cache_path(filename)
+    with open(os.path.join(cache_path, 'meta.json')) as f:
+        meta = json.load(f)
+    index_file = os.path.join(cache_path, 'tag_order.json')
+    order_file = os.path.join(cache_path, 'tag_order.npy')
+    index = None
+    if os.path.exists(index_file) and os.path.exists(order_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    if index is None or index['size'] != meta['size'] or index['mtime_ns'] != meta['mtime_ns']:
+        order = np.argsort(ids, kind='stable')
+        tags, starts = np.unique(np.asarray(ids)[order], return_index=True)
+        np.save(order_file + '.tmp.npy', order)
+        os.replace(order_file + '.tmp.npy', order_file)
+        index = {'size': meta['size'], 'mtime_ns': meta['mtime_ns'],
+                 'tags': tags.tolist(), 'offsets': np.append(starts, len(ids)).tolist()}
+        with open(index_file, 'w') as f:
+            json.dump(index, f)
+    return np.array(index['tags']), np.array(index['offsets']), np.load(order_file, mmap_mode='r')
+
+
+# Per-file task: make sure the column cache and tag order exist and return the per-tag
+# extent and row count
+def _file_extent(filename):
+    _tag_order(filename)
+    arrays = load_FA_arrays(filename, ['ID', 'X', 'Y', 'Z'])
+    grouped = pd.DataFrame({col: np.asarray(arrays[col]) for col in arrays}).groupby('ID')
+    return grouped.min(), grouped.max(), grouped.size()
+
+
+# Per-shard task: gather the shard's tags from every file, sort them by (ID, Timestamp), run
+# kinematics and spike removal and save the output columns as shard `shard` in the shared
+# directory; returns the row count and the quantile sketches of the shard's tags. With
+# fill_method the gaps are filled first (gap_filling.fill_gaps); with clean_axes the spikes
+# are removed jointly from those axes and the kinematics use the cleaned track.
+def _run_shard(filenames, tags, directory, shard, columns, spike_threshold, kernel_size, mode, clean_axes=None,
+               fill_method=None):
+    parts = []
+    for filename in filenames:
+        file_tags, offsets, order = _tag_order(filename)
+        # the shard's tags are a contiguous run of the file's sorted tags, apart from
+        # stationary tags in between
+        lo, hi = np.searchsorted(file_tags, [tags[0], tags[-1] + 1])
+        inside = np.isin(file_tags[lo:hi], tags)
+        rows = np.concatenate([order[offsets[i]:offsets[i + 1]] for i in lo + np.flatnonzero(inside)] or [[]])
+        rows = np.sort(rows.astype(np.int64))    # gather in file order
+        arrays = load_FA_arrays(filename, INPUT_COLUMNS)
+        parts.append({col: arrays[col][rows] for col in INPUT_COLUMNS})
+    inputs = {col: np.concatenate([part[col] for part in parts]) for col in INPUT_COLUMNS}
+    del parts
+    order = np.lexsort((inputs['Timestamp'], inputs['ID']))
+    data = pd.DataFrame({col: values[order] for col, values in inputs.items()})
+    del inputs
+    if fill_method:
+        data = fill_gaps(data, fill_method)
+    if clean_axes:
+        data = calculate_herd_kinematics(clean_herd_positions(data, spike_threshold, kernel_size, mode, clean_axes))
+        # cleaned coordinates as <axis>_fixed, raw ones back in X, Y, ... as without cleaning
+        data = data.assign(**{axis + '_fixed': data[axis] for axis in clean_axes})
+        data = data.assign(**{axis: data[axis + '_raw'] for axis in clean_axes})
+    else:
+        data = calculate_herd_kinematics(data)
+        fixed, spikes = remove_herd_spikes(data, spike_threshold, kernel_size, mode)
+        data['Y_fixed'] = fixed
+        data['Spike'] = spikes
+    for col, dtype in columns.items():
+        np.save(_shard_path(directory, shard, col), data[col].to_numpy().astype(dtype, copy=False))
+    return len(data), KinematicsSketches().update(data)
+
+
+# Split the sorted tags into at most n_shards contiguous groups of similar row count
+def tag_shards(tags, counts, n_shards):
+    offsets = np.r_[0, np.cumsum(counts)]
+    targets = np.linspace(0, offsets[-1], n_shards + 1)[1:-1]
+    cuts = np.clip(np.searchsorted(offsets, targets), 0, len(tags))
+    bounds = np.unique(np.r_[0, cuts, len(tags)])
+    return [tags[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+# Run the herd pipeline over several FA files on a process pool.
+# Returns the merged per-row results and the velocity/acceleration thresholds; the
+# per-(tag, day) sketches are saved to sketch_file if given. fill_method (one of
+# gap_filling.FILL_METHODS) fills the gaps of every tag before spike removal, adding rows with
+# Interpolated=True; clean_axes=('X', 'Y') removes spikes jointly from those axes before the
+# kinematics (clean_herd_positions) and returns them as X_fixed, Y_fixed, ... in place of the
+# Y-only Y_fixed.
+def parallel_pipeline(filenames, workers=None, shards_per_worker=4, spike_threshold=200,
+                      kernel_size=41, mode='zero', y_range_threshold=2600, percentile=95, sketch_file=None,
+                      clean_axes=None, fill_method=None):
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        # by file: column caches, per-tag ranges and row counts
+        extents = list(pool.map(_file_extent, filenames))
+        mins = pd.concat([e[0] for e in extents]).groupby(level=0).min()
+        maxs = pd.concat([e[1] for e in extents]).groupby(level=0).max()
+        counts = pd.concat([e[2] for e in extents]).groupby(level=0).sum()
+        stationary = (maxs['Y'] - mins['Y']).abs() <= y_range_threshold
+        print("Stationary Tags Removed: ", int(stationary.sum()))
+        moving = counts[~stationary.reindex(counts.index).to_numpy()]    # sorted by tag
+
+        directory = _shared_dir()
+        try:
+            columns = {**FA_CACHE_DTYPES, **OUTPUT_COLUMNS}
+            if clean_axes:
+                # one <axis>_fixed per cleaned axis instead of Y_fixed
+                del columns['Y_fixed']
+                columns.update({axis + '_fixed': np.float64 for axis in clean_axes})
+            if fill_method:
+                columns.update({'Gap': str, 'Interpolated': np.bool_})    # Gap as fixed-width strings
+
+            # by tag shard: each worker loads, sorts and processes its own tags
+            shards = tag_shards(moving.index.to_numpy(), moving.to_numpy(), workers * shards_per_worker)
+            futures = [pool.submit(_run_shard, filenames, tags, directory, shard, columns,
+                                   spike_threshold, kernel_size, mode, clean_axes, fill_method)
+                       for shard, tags in enumerate(shards)]
+            # merged in shard order, so the thresholds do not depend on which shard finishes first
+            rows, sketches = 0, KinematicsSketches()
+            for future in futures:
+                shard_rows, shard_sketches = future.result()
+                rows += shard_rows
+                sketches.merge(shard_sketches)
+            assert fill_method or rows == int(moving.sum())
+
+            # join one column at a time out of shared memory and free its shard files right away
+            result = pd.DataFrame(index=pd.RangeIndex(rows))
+            for col in columns:
+                paths = [_shard_path(directory, shard, col) for shard in range(len(shards))]
+                result[col] = np.concatenate([np.load(path) for path in paths]) if paths else np.empty(0, columns[col])
+                for path in paths:
+                    os.remove(path)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    thresholds = {
+        'velocity': sketches.percentile('Velocity', percentile),
+        'acceleration': sketches.percentile('Acceleration', percentile),
+    }
+    if sketch_file is not None:
+        sketches.save(sketch_file)
+    print(f"The calculated velocity threshold is: {thresholds['velocity']}")
+    print(f"The calculated acceleration threshold is: {thresholds['acceleration']}")
+    return result, thresholds
+
+
+if __name__ == "__main__":
+
+    # usage: python parallel_pipeline.py WORKERS FA_1.csv [FA_2.csv ...]
+    parallel_pipeline(sys.argv[2:], workers=int(sys.argv[1]))
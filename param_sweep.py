@@ -0,0 +1,190 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from rolling_median import segmented_rolling_median
+from spikes_medfilt_v2 import (FAIndex, read_FA_file, detect_drop_inactive_tags, _sorted_by_tag_and_time,
+                               _tag_starts, _segmented_diff, _timestamps_as_ms)
+
+
+# Parameter sweep for spike removal. The rolling median is computed once per kernel size;
+# all spike thresholds are then applied at once by broadcasting the deviation from the
+# median against the threshold vector. Velocity of the cleaned track is re-evaluated only
+# on the rows a threshold can change, for every threshold in the same pass. Tags are independent, so groups of tags run in
+# parallel, each group doing all kernels on its own rows.
+#
+#   python param_sweep.py sweep.csv FA_20200919T000000UTC.csv ... --kernels 31 40 41 --thresholds 100 200 300
+
+DEFAULT_KERNELS = [21, 25, 31, 35, 40, 41, 45, 51, 61, 81]
+DEFAULT_THRESHOLDS = list(range(50, 1050, 50))
+VELOCITY_PERCENTILES = (50, 95, 99)
+# above this fraction of changed rows a tag's velocity columns are built in full
+DENSE_FRACTION = 0.25
+
+
+# Per-tag spike and velocity statistics of one tag group for every (kernel, threshold)
+def _sweep_tags(ids, timestamps_ms, x, y, kernel_sizes, thresholds, mode):
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    starts = _tag_starts(ids)
+    bounds = np.flatnonzero(np.r_[starts, True])
+    time_diff = _segmented_diff(timestamps_ms, starts) / 1000.0
+    dx2 = _segmented_diff(x, starts) ** 2
+    y = np.asarray(y, dtype=np.float64)
+    raw_velocity = _velocity(dx2, _segmented_diff(y, starts), time_diff)
+
+    # the raw velocity distribution of every tag is sorted once and shared by all kernels
+    tags = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        order = np.argsort(raw_velocity[start:stop], kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        tags.append((start, stop, raw_velocity[start:stop][order], rank))
+
+    rows = []
+    for kernel_size in kernel_sizes:
+        median = segmented_rolling_median(y, starts, kernel_size, mode)
+        deviation = np.abs(y - median)
+        for start, stop, sorted_velocity, rank in tags:
+            window = slice(start, stop)
+            stats = _tag_stats(y[window], median[window], deviation[window], dx2[window], time_diff[window],
+                               sorted_velocity, rank, thresholds)
+            for j, threshold in enumerate(thresholds):
+                rows.append((kernel_size, threshold, ids[start], stop - start) + tuple(s[j] for s in stats))
+    return rows
+
+
+def _velocity(dx2, dy, time_diff):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocity = np.sqrt(dx2 + dy ** 2) / time_diff
+    velocity[np.isnan(velocity)] = 0.0    # as calculate_herd_velocity does
+    return velocity
+
+
+# Statistics of one tag for all thresholds: (spikes, fraction, velocity mean, percentiles...).
+# Only samples that are a spike at the lowest threshold, and the samples after them, can
+# change velocity; those rows are evaluated for every threshold. When they are few they are
+# merged with the sorted velocities of all other rows instead of sorting every column.
+def _tag_stats(y, median, deviation, dx2, time_diff, sorted_velocity, rank, thresholds):
+    n = len(y)
+    spikes = n - np.searchsorted(np.sort(deviation), thresholds, side='right')
+
+    candidate = deviation > thresholds[0]
+    changed = candidate.copy()
+    changed[1:] |= candidate[:-1]
+    rows = np.flatnonzero(changed)
+    previous = np.maximum(rows - 1, 0)
+    fixed = np.where(deviation[rows, None] > thresholds, median[rows, None], y[rows, None])
+    fixed_previous = np.where(deviation[previous, None] > thresholds, median[previous, None], y[previous, None])
+    changed_velocity = _velocity(dx2[rows, None], fixed - fixed_previous, time_diff[rows, None])
+    changed_velocity[rows == 0] = 0.0    # first sample of the tag
+
+    if len(rows) > n * DENSE_FRACTION:
+        # most rows change (noisy track or low thresholds): full columns and a partition are cheaper
+        velocity = np.repeat(sorted_velocity[rank][:, None], len(thresholds), axis=1)
+        velocity[rows] = changed_velocity
+        means = velocity.mean(axis=0)
+        percentiles = np.percentile(velocity, VELOCITY_PERCENTILES, axis=0)
+        return (spikes, spikes / n, means) + tuple(percentiles)
+
+    changed_velocity.sort(axis=0)
+    keep = np.ones(n, dtype=bool)
+    keep[rank[rows]] = False
+    unchanged = sorted_velocity[keep]
+    means = (unchanged.sum() + changed_velocity.sum(axis=0)) / n
+
+    # k-th smallest of the merge of `unchanged` and each column of `changed_velocity`
+    merged_position = np.arange(len(rows))[:, None] + np.searchsorted(unchanged, changed_velocity, side='right')
+
+    def kth(k):
+        before = (merged_position < k).sum(axis=0)
+        from_changed = (merged_position == k).any(axis=0)
+        changed_value = changed_velocity[np.minimum(before, len(rows) - 1), np.arange(len(thresholds))] \
+            if len(rows) else np.zeros(len(thresholds))
+        unchanged_value = unchanged[np.clip(k - before, 0, max(len(unchanged) - 1, 0))] \
+            if len(unchanged) else np.zeros(len(thresholds))
+        return np.where(from_changed, changed_value, unchanged_value)
+
+    percentiles = []
+    for p in VELOCITY_PERCENTILES:
+        # linear interpolation between closest ranks, as np.percentile does
+        h = (n - 1) * p / 100.0
+        lo = int(np.floor(h))
+        low = kth(lo)
+        high = kth(min(lo + 1, n - 1))
+        percentiles.append(low + (h - lo) * (high - low))
+    return (spikes, spikes / n, means) + tuple(percentiles)
+
+
+def _sweep_task(args):
+    return _sweep_tags(*args)
+
+
+def _tag_groups(ids, n_groups):
+    tag_starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    targets = np.linspace(0, len(ids), n_groups + 1)[1:-1]
+    cuts = tag_starts[np.clip(np.searchsorted(tag_starts, targets), 0, len(tag_starts) - 1)]
+    bounds = np.unique(np.r_[0, cuts, len(ids)])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parameter_sweep(data, kernel_sizes=DEFAULT_KERNELS, thresholds=DEFAULT_THRESHOLDS, mode='zero',
+                    workers=None, groups_per_worker=2):
+    """Spike counts, fraction replaced and velocity statistics per (kernel, threshold, tag).
+
+    `data` is herd FA data (DataFrame or FAIndex) with stationary tags already dropped.
+    Velocity is computed from raw X and the cleaned Y of each setting.
+    """
+    data = _sorted_by_tag_and_time(data)
+    ids = data['ID'].to_numpy()
+    timestamps_ms = _timestamps_as_ms(data['Timestamp'])
+    x = data['X'].to_numpy()
+    y = data['Y'].to_numpy()
+
+    workers = workers or os.cpu_count()
+    tasks = [(ids[s:e], timestamps_ms[s:e], x[s:e], y[s:e], list(kernel_sizes), list(thresholds), mode)
+             for s, e in _tag_groups(ids, workers * groups_per_worker)]
+    if workers == 1 or len(tasks) == 1:
+        parts = [_sweep_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_sweep_task, tasks))
+
+    columns = (['Kernel', 'Threshold', 'ID', 'Samples', 'Spikes', 'Fraction_replaced', 'Velocity_mean']
+               + [f'Velocity_p{p}' for p in VELOCITY_PERCENTILES])
+    report = pd.DataFrame([row for part in parts for row in part], columns=columns)
+    return report.sort_values(['Kernel', 'Threshold', 'ID'], kind='stable').reset_index(drop=True)
+
+
+# Herd totals per (kernel, threshold): spike fraction over all samples and the
+# sample-weighted mean of the per-tag velocity statistics
+def summarize_sweep(report):
+    weighted = report.assign(**{col: report[col] * report['Samples']
+                                for col in report.columns if col.startswith('Velocity')})
+    summary = weighted.groupby(['Kernel', 'Threshold']).sum(numeric_only=True)
+    for col in [c for c in report.columns if c.startswith('Velocity')]:
+        summary[col] = summary[col] / summary['Samples']
+    summary['Fraction_replaced'] = summary['Spikes'] / summary['Samples']
+    return summary.drop(columns='ID').reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep spike_threshold and kernel_size in one pass.')
+    parser.add_argument('output')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--kernels', nargs='+', type=int, default=DEFAULT_KERNELS)
+    parser.add_argument('--thresholds', nargs='+', type=float, default=DEFAULT_THRESHOLDS)
+    parser.add_argument('--mode', default='zero')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    data = pd.concat([read_FA_file(f) for f in args.files], ignore_index=True)
+    data = FAIndex(detect_drop_inactive_tags(data))
+    report = parameter_sweep(data, args.kernels, args.thresholds, args.mode, args.workers)
+    report.to_csv(args.output, index=False)
+    print(summarize_sweep(report).to_string(index=False))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,331 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from spikes_medfilt_v2 import (FA_CACHE_DTYPES, fa_cache_path, load_FA_arrays, build_FA_index, calculate_herd_velocity,
+                               calculate_herd_acceleration, calculate_herd_angular_observables, remove_herd_spikes,
+                               clean_herd_positions)
+from quantile_sketch import KinematicsSketches
+from gap_filling import fill_gaps
+
+
+# Config-driven batch runner. The pipeline stages are nodes of a small DAG and a job names
+# the outputs it wants; only those nodes and their dependencies are evaluated, each once.
+# Tag lists and time windows are pushed down into loading: rows of other tags and times
+# are never turned into a DataFrame, and files outside the window or without the job's tags
+# are skipped. Stationary tags are still decided on their whole track, as
+# detect_drop_inactive_tags does, from per-tag Y extents kept next to each file's column
+# cache (file_summary), so a job only scans a file's rows the first time it is used. With
+# "fill_gaps" set, the gaps of every tag are filled with that method before spike removal
+# (gap_filling.fill_gaps). With "clean_axes" set, spikes are removed jointly from those axes (clean_herd_positions)
+# before velocity, so all kinematics are computed from the cleaned track.
+#
+#   python pipeline_dag.py pipeline.json
+#   python pipeline_dag.py pipeline.json --outputs velocity_threshold --dry-run
+#
+# The config is JSON: job settings at the top level (defaults) and an optional "jobs"
+# list whose entries override them, e.g.
+#   {"files": ["FA_20191115T000000UTC.csv"], "outputs": ["velocity_threshold"],
+#    "jobs": [{"name": "cow246", "tags": [2417246],
+#              "start_time": "2019-11-15 02:05:00", "end_time": "2019-11-15 02:20:00"}]}
+
+DEFAULTS = {
+    'name': 'job',
+    'files': [],
+    'tags': None,            # None for all tags
+    'start_time': None,      # None for no bound
+    'end_time': None,
+    'spike_threshold': 200,
+    'kernel_size': 41,
+    'mode': 'zero',
+    'y_range_threshold': 2600,
+    'percentile': 95,
+    'fill_gaps': None,       # a gap_filling.FILL_METHODS entry: fill gaps before spike removal
+    'clean_axes': None,      # e.g. ["X", "Y"]: joint spike removal on these axes before the kinematics
+    'outputs': ['velocity_threshold', 'acceleration_threshold'],
+    'output_dir': 'pipeline_output',
+    'workers': None,
+}
+
+
+def _ms(time_value):
+    return None if time_value is None else pd.to_datetime(time_value).value // 10**6
+
+
+# Time range, time order and per-tag Y extent of one FA file, stored as summary.json next to
+# its column cache and rebuilt when the cache was built from another version of the CSV.
+# Without a cache (it could not be written) the summary is computed on every call.
+def file_summary(filename):
+    arrays = load_FA_arrays(filename, ['ID', 'Timestamp', 'Y'])    # builds or refreshes the cache
+    cache_path = fa_cache_path(filename)
+    summary_file = os.path.join(cache_path, 'summary.json')
+    try:
+        with open(os.path.join(cache_path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    if meta is not None and os.path.exists(summary_file):
+        with open(summary_file) as f:
+            summary = json.load(f)
+        if summary['size'] == meta['size'] and summary['mtime_ns'] == meta['mtime_ns']:
+            return summary
+
+    timestamps = np.asarray(arrays['Timestamp'])
+    extent = pd.DataFrame({'ID': arrays['ID'], 'Y': arrays['Y']}).groupby('ID')['Y'].agg(['min', 'max'])
+    summary = {
+        'size': meta and meta['size'],
+        'mtime_ns': meta and meta['mtime_ns'],
+        'first_ms': int(timestamps.min()) if len(timestamps) else None,
+        'last_ms': int(timestamps.max()) if len(timestamps) else None,
+        'time_sorted': bool(np.all(np.diff(timestamps) >= 0)),
+        'tags': extent.index.tolist(),
+        'y_min': extent['min'].tolist(),
+        'y_max': extent['max'].tolist(),
+    }
+    if meta is not None:
+        try:
+            with open(summary_file + '.tmp', 'w') as f:
+                json.dump(summary, f)
+            os.replace(summary_file + '.tmp', summary_file)
+        except OSError:
+            pass
+    return summary
+
+
+# Rows of one FA file that pass the tag and time predicates, read from the column cache
+def load_FA_rows(filename, columns, tags=None, start_ms=None, end_ms=None):
+    arrays = load_FA_arrays(filename, sorted(set(columns) | {'ID', 'Timestamp'}))
+    timestamps = arrays['Timestamp']
+    rows = slice(0, len(timestamps))
+    summary = file_summary(filename)
+    if tags is not None and not np.isin(summary['tags'], tags).any():
+        rows = slice(0, 0)    # none of the tags is in this file
+        tags = None
+    elif (start_ms is not None or end_ms is not None) and len(timestamps):
+        if ((start_ms is not None and summary['last_ms'] < start_ms)
+                or (end_ms is not None and summary['first_ms'] > end_ms)):
+            rows = slice(0, 0)    # the whole file is outside the window
+        elif summary['time_sorted']:
+            # bound the window by binary search, no other rows are touched
+            lo = np.searchsorted(timestamps, start_ms, side='left') if start_ms is not None else 0
+            hi = np.searchsorted(timestamps, end_ms, side='right') if end_ms is not None else len(timestamps)
+            rows = slice(lo, hi)
+        else:
+            window = np.ones(len(timestamps), dtype=bool)
+            if start_ms is not None:
+                window &= timestamps >= start_ms
+            if end_ms is not None:
+                window &= timestamps <= end_ms
+            rows = np.flatnonzero(window)
+    if tags is not None:
+        selected = np.isin(arrays['ID'][rows], tags)
+        rows = (np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows)[selected]
+    return pd.DataFrame({col: np.array(arrays[col][rows]) for col in columns})
+
+
+# Node functions: (job, *dependency values) -> value
+def _raw(job):
+    start_ms, end_ms = _ms(job['start_time']), _ms(job['end_time'])
+    parts = [load_FA_rows(f, list(FA_CACHE_DTYPES), job['tags'], start_ms, end_ms) for f in job['files']]
+    return pd.concat(parts, ignore_index=True)
+
+
+def _stationary(job):
+    # per-tag Y range over the whole files, not just the window
+    parts = [pd.DataFrame({'ID': summary['tags'], 'min': summary['y_min'], 'max': summary['y_max']})
+             for summary in map(file_summary, job['files'])]
+    extent = pd.concat(parts).groupby('ID').agg({'min': 'min', 'max': 'max'})
+    if job['tags'] is not None:
+        extent = extent[extent.index.isin(job['tags'])]
+    stationary = extent.index[(extent['max'] - extent['min']).abs() <= job['y_range_threshold']]
+    print("Stationary Tags Removed: ", len(stationary))
+    return stationary.to_numpy()
+
+
+def _active(job, raw, stationary):
+    return raw[~raw['ID'].isin(stationary)]
+
+
+# Active rows with their gaps filled (Gap and Interpolated added); only planned with fill_gaps
+def _filled(job, active):
+    return fill_gaps(active, job['fill_gaps'])
+
+
+def _index(job, active):
+    return build_FA_index(active)
+
+
+# Spike-cleaned positions (X_raw, Y_raw, ... and Spike kept); only planned with clean_axes
+def _clean_positions(job, index):
+    return build_FA_index(clean_herd_positions(index, job['spike_threshold'], job['kernel_size'], job['mode'],
+                                               job['clean_axes']))
+
+
+def _velocity(job, index):
+    return calculate_herd_velocity(index)
+
+
+def _acceleration(job, velocity):
+    return calculate_herd_acceleration(velocity.copy())
+
+
+def _kinematics(job, acceleration):
+    return calculate_herd_angular_observables(acceleration.copy())
+
+
+def _spikes(job, index):
+    data = index.data
+    if job['clean_axes']:
+        # already removed jointly by clean_positions
+        fixed, spikes = data['Y'], data['Spike']
+    else:
+        fixed, spikes = remove_herd_spikes(data, job['spike_threshold'], job['kernel_size'], job['mode'])
+    return pd.DataFrame({'ID': data['ID'].to_numpy(), 'Timestamp': data['Timestamp'].to_numpy(),
+                         'Y_fixed': fixed.to_numpy(), 'Spike': spikes.to_numpy()})
+
+
+def _sketches(job, acceleration):
+    return KinematicsSketches().update(acceleration)
+
+
+def _velocity_threshold(job, velocity):
+    return KinematicsSketches(['Velocity']).update(velocity).percentile('Velocity', job['percentile'])
+
+
+def _acceleration_threshold(job, sketches):
+    return sketches.percentile('Acceleration', job['percentile'])
+
+
+def _table(job, kinematics, spikes):
+    return kinematics.assign(Y_fixed=spikes['Y_fixed'].to_numpy(), Spike=spikes['Spike'].to_numpy())
+
+
+def _plots(job, table, velocity_threshold, acceleration_threshold):
+    from render import render_tags
+    output_dir = os.path.join(job['output_dir'], job['name'] + '_plots')
+    return render_tags(table, output_dir, velocity_threshold, acceleration_threshold, job['workers'])
+
+
+# name -> (dependencies, function)
+NODES = {
+    'raw': ([], _raw),
+    'stationary': ([], _stationary),
+    'active': (['raw', 'stationary'], _active),
+    'filled': (['active'], _filled),
+    'index': (['filled'], _index),
+    'clean_positions': (['index'], _clean_positions),
+    'velocity': (['clean_positions'], _velocity),
+    'acceleration': (['velocity'], _acceleration),
+    'kinematics': (['acceleration'], _kinematics),
+    'spikes': (['clean_positions'], _spikes),
+    'sketches': (['acceleration'], _sketches),
+    'velocity_threshold': (['velocity'], _velocity_threshold),
+    'acceleration_threshold': (['sketches'], _acceleration_threshold),
+    'table': (['kinematics', 'spikes'], _table),
+    'plots': (['table', 'velocity_threshold', 'acceleration_threshold'], _plots),
+}
+
+
+# Optional nodes: node -> (job setting that enables it, node its dependents read otherwise)
+OPTIONAL = {
+    'filled': ('fill_gaps', 'active'),
+    'clean_positions': ('clean_axes', 'index'),
+}
+
+
+# Dependencies of a node for one job: an optional node whose setting is off is skipped and
+# its dependents read its input directly
+def dependencies(name, job=None):
+    job = {**DEFAULTS, **(job or {})}
+    skipped = {node: fallback for node, (setting, fallback) in OPTIONAL.items() if not job[setting]}
+    return [skipped.get(d, d) for d in NODES[name][0]]
+
+
+# Nodes needed for the requested outputs, dependencies first
+def plan(outputs, job=None):
+    order = []
+
+    def visit(name):
+        if name not in NODES:
+            raise ValueError(f"Unknown pipeline output: {name}")
+        if name in order:
+            return
+        for dependency in dependencies(name, job):
+            visit(dependency)
+        order.append(name)
+
+    for name in outputs:
+        visit(name)
+    return order
+
+
+# Evaluate one job and return {output name: value}
+def run_job(job):
+    job = {**DEFAULTS, **job}
+    order = plan(job['outputs'], job)
+    # position of the last node that needs each value, so it can be dropped after that
+    last_use = {dependency: i for i, name in enumerate(order) for dependency in dependencies(name, job)}
+    values = {}
+    for i, name in enumerate(order):
+        needed = dependencies(name, job)
+        values[name] = NODES[name][1](job, *[values[d] for d in needed])
+        for done in [d for d in needed if last_use[d] == i and d not in job['outputs']]:
+            del values[done]
+    return {name: values[name] for name in job['outputs']}
+
+
+# Save results: DataFrames as CSV, numbers and sketches in <name>_results.json
+def save_results(job, results):
+    os.makedirs(job['output_dir'], exist_ok=True)
+    summary = {}
+    for name, value in results.items():
+        if isinstance(value, pd.DataFrame):
+            path = os.path.join(job['output_dir'], f"{job['name']}_{name}.csv")
+            value.to_csv(path, index=False)
+            summary[name] = path
+        elif isinstance(value, KinematicsSketches):
+            summary[name] = value.save(os.path.join(job['output_dir'], f"{job['name']}_{name}.json"))
+        elif isinstance(value, (int, float, np.number)):
+            summary[name] = float(value)
+        elif isinstance(value, list):
+            summary[name] = [list(v) if isinstance(v, tuple) else v for v in value]
+    path = os.path.join(job['output_dir'], f"{job['name']}_results.json")
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+# Jobs of a config: top-level settings are defaults for every entry of "jobs"
+def load_jobs(config_file):
+    with open(config_file) as f:
+        config = json.load(f)
+    base = {key: value for key, value in config.items() if key != 'jobs'}
+    jobs = config.get('jobs') or [{}]
+    return [{**DEFAULTS, **base, **job} for job in jobs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run pipeline jobs from a JSON config.')
+    parser.add_argument('config')
+    parser.add_argument('--outputs', nargs='+', help=f"override the outputs of every job ({', '.join(NODES)})")
+    parser.add_argument('--jobs', nargs='+', help='only run the jobs with these names')
+    parser.add_argument('--dry-run', action='store_true', help='print the stages each job would run')
+    args = parser.parse_args()
+
+    for job in load_jobs(args.config):
+        if args.jobs and job['name'] not in args.jobs:
+            continue
+        if args.outputs:
+            job['outputs'] = args.outputs
+        print(f"{job['name']}: {' -> '.join(plan(job['outputs'], job))}")
+        if args.dry_run:
+            continue
+        summary = save_results(job, run_job(job))
+        for name, value in summary.items():
+            print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,250 @@
+import json
+import numpy as np
+
+
+# Streaming quantiles for the velocity/acceleration thresholds. A t-digest keeps about a
+# hundred weighted centroids, small near the tails and larger in the middle, so extreme
+# percentiles stay accurate while the sketch size does not depend on the number of values.
+# Digests merge (shards, tags, days) and serialize to JSON, so week-level thresholds can be
+# built from stored daily sketches without reading the raw data again. Small digests (up
+# to EXACT_FACTOR * compression values, e.g. one 15-minute window) keep every value and
+# give the same percentiles as np.percentile; they are compressed once they grow past that.
+
+DEFAULT_COMPRESSION = 200    # ~100 centroids, rank error around 1e-4
+EXACT_FACTOR = 20
+MS_PER_DAY = 86400000
+
+
+class TDigest:
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+        # +-inf (e.g. a velocity over a zero time step) are counted, not put in centroids
+        self.n_neginf = 0
+        self.n_posinf = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def __len__(self):
+        return int(self.weights.sum() + self._buffered) + self.n_neginf + self.n_posinf
+
+    # Add values; NaNs are ignored
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        infinite = np.isinf(values)
+        if infinite.any():
+            self.n_posinf += int((values[infinite] > 0).sum())
+            self.n_neginf += int((values[infinite] < 0).sum())
+            values = values[~infinite]
+        if len(values) == 0:
+            return self
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._buffer.append(values)
+        self._buffered += len(values)
+        if self._buffered > EXACT_FACTOR * self.compression:
+            self._flush()
+        return self
+
+    def merge(self, other):
+        other._flush()
+        self._flush()
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.n_neginf += other.n_neginf
+        self.n_posinf += other.n_posinf
+        self._compress()
+        return self
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        values = np.concatenate(self._buffer)
+        self._buffer, self._buffered = [], 0
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, np.ones(len(values))])
+        self._compress()
+
+    # Whether every value is still kept as its own centroid
+    def _exact(self):
+        return bool(np.all(self.weights == 1))
+
+    # Merge neighbouring centroids whose left edges fall in the same unit of the scale
+    # function k(q) = compression / pi * arcsin(2q - 1), which is steep near both tails
+    # and keeps the centroids there small. Small exact digests are only sorted.
+    def _compress(self):
+        if len(self.means) == 0:
+            return
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+        if len(means) <= EXACT_FACTOR * self.compression and self._exact():
+            self.means, self.weights = means, weights
+            return
+        cumulative = np.cumsum(weights)
+        q_left = (cumulative - weights) / cumulative[-1]
+        k = np.floor(self.compression / np.pi * np.arcsin(2 * q_left - 1))
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    # Value at quantile q in [0, 1] (q=0.95 for the 95th percentile)
+    def quantile(self, q):
+        self._flush()
+        finite = self.weights.sum()
+        total = finite + self.n_neginf + self.n_posinf
+        if total == 0:
+            return np.nan
+        rank = np.clip(q, 0, 1) * total - self.n_neginf
+        if rank < 0:
+            return -np.inf
+        if rank > finite:
+            return np.inf
+        if self._exact():
+            return self._exact_quantile(q, total)
+        centres = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(rank, np.r_[0, centres, finite], np.r_[self.min, self.means, self.max]))
+
+    # Linear interpolation between the closest ranks, as np.percentile does
+    def _exact_quantile(self, q, total):
+        h = (total - 1) * np.clip(q, 0, 1)
+        lo = int(np.floor(h))
+        hi = min(lo + 1, int(total) - 1)
+        values = np.r_[np.full(self.n_neginf, -np.inf), self.means, np.full(self.n_posinf, np.inf)]
+        if h == lo or values[lo] == values[hi]:
+            return float(values[lo])
+        return float(values[lo] + (h - lo) * (values[hi] - values[lo]))
+
+    def percentile(self, p):
+        return self.quantile(p / 100.0)
+
+    def to_dict(self):
+        self._flush()
+        return {
+            'compression': self.compression,
+            'means': self.means.tolist(),
+            'weights': self.weights.tolist(),
+            'min': None if np.isinf(self.min) else float(self.min),
+            'max': None if np.isinf(self.max) else float(self.max),
+            'n_neginf': self.n_neginf,
+            'n_posinf': self.n_posinf,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        digest = cls(d['compression'])
+        digest.means = np.asarray(d['means'], dtype=np.float64)
+        digest.weights = np.asarray(d['weights'], dtype=np.float64)
+        digest.min = np.inf if d['min'] is None else d['min']
+        digest.max = -np.inf if d['max'] is None else d['max']
+        digest.n_neginf = d['n_neginf']
+        digest.n_posinf = d['n_posinf']
+        return digest
+
+
+# Timestamps (int ms or datetimes) as day numbers since the epoch
+def _days(timestamps):
+    values = np.asarray(timestamps)
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = values.astype('datetime64[ms]').astype(np.int64)
+    return values.astype(np.int64) // MS_PER_DAY
+
+
+def _day_name(day):
+    return str(np.datetime64(int(day), 'D'))
+
+
+# One digest per (column, tag, day) of kinematics output; herd-wide, per-tag and
+# multi-day quantiles are answered by merging the matching digests
+class KinematicsSketches:
+    def __init__(self, columns=('Velocity', 'Acceleration'), compression=DEFAULT_COMPRESSION):
+        self.columns = list(columns)
+        self.compression = compression
+        self.digests = {}    # (column, tag, 'YYYY-MM-DD') -> TDigest
+
+    # Fold in rows with ID, Timestamp and the sketched columns (any row order)
+    def update(self, data):
+        if len(data) == 0:
+            return self
+        ids = data['ID'].to_numpy()
+        days = _days(data['Timestamp'])
+        order = None
+        if np.any(np.diff(ids) < 0) or np.any((np.diff(ids) == 0) & (np.diff(days) < 0)):
+            order = np.lexsort((days, ids))
+            ids, days = ids[order], days[order]
+        bounds = np.flatnonzero(np.r_[True, (ids[1:] != ids[:-1]) | (days[1:] != days[:-1]), True])
+        for col in self.columns:
+            values = data[col].to_numpy()
+            if order is not None:
+                values = values[order]
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                key = (col, int(ids[start]), _day_name(days[start]))
+                if key not in self.digests:
+                    self.digests[key] = TDigest(self.compression)
+                self.digests[key].update(values[start:stop])
+        return self
+
+    def merge(self, other):
+        for key, digest in other.digests.items():
+            if key in self.digests:
+                self.digests[key].merge(digest)
+            else:
+                self.digests[key] = TDigest.from_dict(digest.to_dict())
+        return self
+
+    def tags(self):
+        return sorted({tag for _, tag, _ in self.digests})
+
+    def days(self):
+        return sorted({day for _, _, day in self.digests})
+
+    # Merged digest of one column, optionally restricted to some tags and/or days
+    def digest(self, column, tags=None, days=None):
+        tags = None if tags is None else set(np.atleast_1d(tags).tolist())
+        days = None if days is None else {str(day) for day in np.atleast_1d(days)}
+        merged = TDigest(self.compression)
+        for (col, tag, day), digest in self.digests.items():
+            if col == column and (tags is None or tag in tags) and (days is None or day in days):
+                merged.merge(digest)
+        return merged
+
+    def percentile(self, column, p=95, tags=None, days=None):
+        return self.digest(column, tags, days).percentile(p)
+
+    # Percentile of one column for every tag
+    def per_tag(self, column, p=95, days=None):
+        return {tag: self.percentile(column, p, tag, days) for tag in self.tags()}
+
+    def to_dict(self):
+        return {
+            'columns': self.columns,
+            'compression': self.compression,
+            'digests': [[col, tag, day, digest.to_dict()] for (col, tag, day), digest in self.digests.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketches = cls(d['columns'], d['compression'])
+        for col, tag, day, digest in d['digests']:
+            sketches.digests[(col, tag, day)] = TDigest.from_dict(digest)
+        return sketches
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        return path
+
+    # Load one sketch file, or several (e.g. the daily files of a week) merged into one
+    @classmethod
+    def load(cls, *paths):
+        sketches = None
+        for path in paths:
+            with open(path) as f:
+                loaded = cls.from_dict(json.load(f))
+            sketches = loaded if sketches is None else sketches.merge(loaded)
+        return sketches
@@ -0,0 +1,216 @@
+import os
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Raster rendering for combined_plots / angular_plots. Points are first reduced with NumPy
+# to fixed-size 2D density grids, per-time-bin min/max envelopes and histograms, and only
+# those are drawn, so the drawing time does not depend on the number of rows.
+
+GRID_BINS = 200     # cells per axis of the X/Y density rasters
+TIME_BINS = 1000    # bins of the signal-over-time envelopes
+HIST_BINS = 30
+
+
+# Min/max of `values` in TIME_BINS equal time bins (times sorted, int64 ms)
+def time_envelope(times_ms, values, mask=None, time_bins=TIME_BINS):
+    values = np.asarray(values, dtype=np.float64)
+    if mask is not None:
+        times_ms, values = times_ms[mask], values[mask]
+    if len(values) == 0:
+        return np.array([], dtype='datetime64[ms]'), np.array([]), np.array([])
+    edges = np.linspace(times_ms[0], times_ms[-1] + 1, time_bins + 1)
+    bins = np.searchsorted(edges, times_ms, side='right') - 1
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    centres = ((edges[bins[starts]] + edges[bins[starts] + 1]) / 2).astype('int64').astype('datetime64[ms]')
+    return centres, np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)
+
+
+# Density grids of (x, y) for several masks over shared extents
+def density_grids(x, y, masks, bins=GRID_BINS):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    extent = [[np.nanmin(x), np.nanmax(x) + 1e-9], [np.nanmin(y), np.nanmax(y) + 1e-9]]
+    grids = [np.histogram2d(x[m], y[m], bins=bins, range=extent)[0].T for m in masks]
+    return grids, (extent[0][0], extent[0][1], extent[1][0], extent[1][1])
+
+
+def histogram(values, bins=HIST_BINS):
+    values = np.asarray(values, dtype=np.float64)
+    return np.histogram(values[np.isfinite(values)], bins=bins)
+
+
+def _timestamps_ms(timestamps):
+    values = np.asarray(timestamps)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ms]').astype(np.int64)
+    return values.astype(np.int64)
+
+
+# Everything the combined figure needs, reduced to fixed-size arrays
+def aggregate_combined(data, fixed_signal, spikes, velocity_threshold, acc_threshold,
+                       bins=GRID_BINS, time_bins=TIME_BINS):
+    t = _timestamps_ms(data['Timestamp'])
+    x = data['X'].to_numpy(dtype=np.float64)
+    y = data['Y'].to_numpy(dtype=np.float64)
+    fixed = np.asarray(fixed_signal, dtype=np.float64)
+    spikes = np.asarray(spikes, dtype=bool)
+    velocity = data['Velocity'].to_numpy()
+    acceleration = data['Acceleration'].to_numpy()
+    all_rows = np.ones(len(t), dtype=bool)
+
+    raw, extent = density_grids(x, y, [all_rows, spikes], bins)
+    clean, clean_extent = density_grids(x, fixed, [all_rows], bins)
+    speed, _ = density_grids(x, y, [velocity <= velocity_threshold, velocity > velocity_threshold], bins)
+    acc, _ = density_grids(x, y, [acceleration <= acc_threshold, acceleration > acc_threshold], bins)
+    return {
+        'signal': time_envelope(t, y, time_bins=time_bins),
+        'signal_spikes': time_envelope(t, y, spikes, time_bins),
+        'fixed': time_envelope(t, fixed, time_bins=time_bins),
+        'velocity_hist': histogram(velocity),
+        'acceleration_hist': histogram(acceleration),
+        'raw': raw, 'clean': clean, 'speed': speed, 'acc': acc,
+        'extent': extent, 'clean_extent': clean_extent,
+    }
+
+
+def _envelope(ax, envelope, color, label):
+    centres, low, high = envelope
+    if len(centres):
+        ax.fill_between(centres, low, high, color=color, alpha=0.6, linewidth=0, label=label)
+
+
+def _raster(ax, grids, extent, labels):
+    cmaps = ['Blues', 'Reds']
+    for grid, cmap, label in zip(grids, cmaps, labels):
+        if grid.max() == 0:
+            continue
+        masked = np.ma.masked_equal(grid, 0)
+        ax.imshow(masked, origin='lower', extent=extent, aspect='auto', cmap=cmap,
+                  norm=LogNorm(vmin=1, vmax=grid.max()), interpolation='nearest')
+        ax.plot([], [], 's', color=plt.get_cmap(cmap)(0.7), label=label)
+    ax.legend()
+
+
+# Same 2x4 layout as combined_plots, drawn from aggregate_combined() output
+def draw_combined(panels, output_file="com_plot.png"):
+    fig, axs = plt.subplots(2, 4, figsize=(16, 8))
+
+    _envelope(axs[0, 0], panels['signal'], 'tab:blue', 'Original Signal')
+    centres, low, high = panels['signal_spikes']
+    axs[0, 0].scatter(np.r_[centres, centres], np.r_[low, high], color='red', s=4, label='Spikes')
+    axs[0, 0].set_xlabel('Time')
+    axs[0, 0].set_ylabel('Y')
+    axs[0, 0].legend()
+
+    _envelope(axs[0, 1], panels['fixed'], 'orange', 'Fixed Signal')
+    axs[0, 1].set_xlabel('Time')
+    axs[0, 1].set_ylabel('Y cleaned')
+    axs[0, 1].legend()
+
+    counts, edges = panels['velocity_hist']
+    axs[0, 2].stairs(counts, edges, fill=True, color='blue', alpha=0.7)
+    axs[0, 2].set_xlabel('Velocity')
+    axs[0, 2].set_ylabel('Frequency')
+
+    counts, edges = panels['acceleration_hist']
+    axs[0, 3].stairs(counts, edges, fill=True, color='blue', alpha=0.7)
+    axs[0, 3].set_xlabel('Acceleration')
+    axs[0, 3].set_ylabel('Frequency')
+
+    _raster(axs[1, 0], panels['raw'], panels['extent'], ['Original Data', 'Spikes'])
+    axs[1, 0].set_xlabel('X')
+    axs[1, 0].set_ylabel('Y')
+    _raster(axs[1, 1], panels['clean'], panels['clean_extent'], ['Data after Spike Removal'])
+    axs[1, 1].set_xlabel('X')
+    axs[1, 1].set_ylabel('Y cleaned')
+    _raster(axs[1, 2], panels['speed'], panels['extent'], ['Normal Speed', 'Abnormal Speed'])
+    axs[1, 2].set_xlabel('X Position')
+    axs[1, 2].set_ylabel('Y Position')
+    _raster(axs[1, 3], panels['acc'], panels['extent'], ['Normal Acceleration', 'Abnormal Acceleration'])
+    axs[1, 3].set_xlabel('X Position')
+    axs[1, 3].set_ylabel('Y Position')
+
+    plt.tight_layout()
+    plt.savefig(output_file)
+    plt.close(fig)
+    return output_file
+
+
+def aggregate_angular(data, bins=GRID_BINS):
+    velocity = data['Velocity'].to_numpy(dtype=np.float64)
+    turn = data['Theta_diff'].to_numpy(dtype=np.float64)
+    ok = np.isfinite(velocity) & np.isfinite(turn)
+    grids, extent = density_grids(velocity[ok], turn[ok], [np.ones(ok.sum(), dtype=bool)], bins)
+    return {
+        'theta_hist': histogram(data['Theta']),
+        'cosine_hist': histogram(data['Cosine']),
+        'theta_diff_hist': histogram(turn),
+        'velocity_turn': grids,
+        'extent': extent,
+    }
+
+
+# Same 1x4 layout as angular_plots, drawn from aggregate_angular() output
+def draw_angular(panels, output_file="ang_plot.png"):
+    fig, axs = plt.subplots(1, 4, figsize=(16, 4))
+    for ax, key, label in zip(axs[:3], ['theta_hist', 'cosine_hist', 'theta_diff_hist'], ['Theta', 'Cosine', 'Theta Diff']):
+        counts, edges = panels[key]
+        ax.stairs(counts, edges, fill=True, color='blue', alpha=0.7)
+        ax.set_xlabel(label)
+        ax.set_ylabel('Frequency')
+    _raster(axs[3], panels['velocity_turn'], panels['extent'], ['All data'])
+    axs[3].set_xlabel('Velocity')
+    axs[3].set_ylabel('Theta Diff')
+    plt.tight_layout()
+    plt.savefig(output_file)
+    plt.close(fig)
+    return output_file
+
+
+def raster_combined_plots(data, fixed_signal, spikes, velocity_threshold, acc_threshold, output_file="com_plot.png"):
+    return draw_combined(aggregate_combined(data, fixed_signal, spikes, velocity_threshold, acc_threshold), output_file)
+
+
+def raster_angular_plots(data, output_file="ang_plot.png"):
+    return draw_angular(aggregate_angular(data), output_file)
+
+
+# Worker processes draw off-screen
+def _init_worker():
+    matplotlib.use('Agg')
+
+
+def _draw_tag(args):
+    combined, angular, combined_file, angular_file = args
+    return draw_combined(combined, combined_file), draw_angular(angular, angular_file)
+
+
+# Per-tag figures for herd data with Velocity, Acceleration, angular, Y_fixed and Spike
+# columns (e.g. calculate_herd_kinematics + remove_herd_spikes). The rows are reduced
+# here and only the small aggregates are sent to the drawing processes.
+def render_tags(data, output_dir, velocity_threshold, acc_threshold, workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    ids = data['ID'].to_numpy()
+    tags, starts = np.unique(ids, return_index=True)
+    order = np.argsort(ids, kind='stable') if not np.all(ids[1:] >= ids[:-1]) else None
+    if order is not None:
+        data = data.iloc[order]
+        tags, starts = np.unique(data['ID'].to_numpy(), return_index=True)
+    bounds = np.append(starts, len(data))
+
+    tasks = []
+    for tag, start, stop in zip(tags, bounds[:-1], bounds[1:]):
+        tag_data = data.iloc[start:stop]
+        tasks.append((
+            aggregate_combined(tag_data, tag_data['Y_fixed'], tag_data['Spike'], velocity_threshold, acc_threshold),
+            aggregate_angular(tag_data),
+            os.path.join(output_dir, f"com_plot_{tag}.png"),
+            os.path.join(output_dir, f"ang_plot_{tag}.png"),
+        ))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        return list(pool.map(_draw_tag, tasks))
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from rolling_median import window_extent
+from spikes_medfilt_v2 import FA_CACHE_DTYPES, load_FA_arrays, calculate_herd_kinematics, remove_herd_spikes
+
+
+# Content-addressed cache of per-(tag, day) pipeline results for incremental runs over a
+# rolling window of daily FA files. A partition is keyed by the hashes of its own file and
+# of the other days' files it reads as context, the tag, the stage and its parameters. The
+# context is what the full herd run would see of the tag across midnight: half a median
+# window on either side, and on the earlier side everything back to the tag's last movement,
+# because a heading is carried over any number of samples without movement. That is
+# usually a few rows of the day before, so when a new day arrives only the new day and the
+# day before it get new keys; everything else is read back from disk.
+#
+# Entries are .npz files under the cache directory. Their mtime is the last use, and the
+# least recently used entries are deleted once the cache grows beyond max_bytes.
+
+RESULT_CACHE_VERSION = 2
+STAGE = 'kinematics+spikes'
+FA_COLUMNS = list(FA_CACHE_DTYPES)
+# Samples in front of a day's first sample that acceleration needs (two velocities back)
+KINEMATICS_CONTEXT = 2
+
+
+class ResultCache:
+    def __init__(self, directory='.fa_results', max_bytes=2 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(directory, 'entries'), exist_ok=True)
+        self._hash_file = os.path.join(directory, 'hashes.json')
+        self._hashes = {}
+        if os.path.exists(self._hash_file):
+            with open(self._hash_file) as f:
+                self._hashes = json.load(f)
+
+    # sha256 of a file's content, remembered per (path, size, mtime) so unchanged files
+    # are not read again
+    def file_hash(self, filename):
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        known = self._hashes.get(path)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        self._hashes[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+        with open(self._hash_file, 'w') as f:
+            json.dump(self._hashes, f)
+        return digest.hexdigest()
+
+    # Cache key of any JSON-serializable parts (hashes, tag, stage, parameters)
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps([RESULT_CACHE_VERSION] + list(parts), sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'entries', key[:2], key + '.npz')
+
+    # Whether an entry exists (and mark it as used, so it is kept)
+    def __contains__(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        os.utime(path)
+        return True
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        with np.load(path, allow_pickle=False) as stored:
+            frame = pd.DataFrame({col: stored[col] for col in stored.files})
+        os.utime(path)    # mark as recently used
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a temporary name first so a crashed run never leaves a half-written entry
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **{col: frame[col].to_numpy() for col in frame.columns})
+        os.replace(tmp_path, path)
+
+    # All entries as (last use, size, path), oldest first
+    def entries(self):
+        found = []
+        root = os.path.join(self.directory, 'entries')
+        for sub in os.listdir(root):
+            for name in os.listdir(os.path.join(root, sub)):
+                path = os.path.join(root, sub, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(found)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    # Delete least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+
+def _frame(arrays, rows=None):
+    return pd.DataFrame({col: np.asarray(arrays[col]) if rows is None else arrays[col][rows] for col in FA_COLUMNS})
+
+
+# Per-tag min/max of X, Y, Z of one file, cached by the file's hash
+def file_extent(filename, cache):
+    key = cache.key(cache.file_hash(filename), 'extent')
+    extent = cache.get(key)
+    if extent is None:
+        arrays = load_FA_arrays(filename, ['ID', 'X', 'Y', 'Z'])
+        grouped = pd.DataFrame({col: np.asarray(arrays[col]) for col in arrays}).groupby('ID')
+        mins, maxs = grouped.min(), grouped.max()
+        extent = pd.DataFrame({'ID': mins.index.to_numpy()})
+        for col in ['X', 'Y', 'Z']:
+            extent[col + '_min'] = mins[col].to_numpy()
+            extent[col + '_max'] = maxs[col].to_numpy()
+        cache.put(key, extent)
+    return extent
+
+
+# Stationary tags over all files, from the cached per-file extents
+def stationary_tags(filenames, cache, y_range_threshold=2600):
+    extent = pd.concat([file_extent(f, cache) for f in filenames]).groupby('ID').agg({'Y_min': 'min', 'Y_max': 'max'})
+    return extent.index[(extent['Y_max'] - extent['Y_min']).abs() <= y_range_threshold].to_numpy()
+
+
+# Per-tag row count of one file and the rows at its end that reach back to the tag's last
+# movement (the sample before it included), cached by the file's hash. Tail equals Count
+# when the tag does not move in this file.
+def file_tails(filename, cache):
+    key = cache.key(cache.file_hash(filename), 'tails')
+    tails = cache.get(key)
+    if tails is None:
+        arrays = load_FA_arrays(filename, ['ID', 'Timestamp', 'X', 'Y'])
+        order = np.lexsort((arrays['Timestamp'], arrays['ID']))
+        ids = np.asarray(arrays['ID'])[order]
+        x, y = np.asarray(arrays['X'])[order], np.asarray(arrays['Y'])[order]
+        tags, starts, counts = np.unique(ids, return_index=True, return_counts=True)
+        moves = np.flatnonzero((ids[1:] == ids[:-1]) & ((x[1:] != x[:-1]) | (y[1:] != y[:-1]))) + 1
+        last_move = pd.Series(moves, index=ids[moves]).groupby(level=0).max().reindex(tags).to_numpy()
+        moved = ~np.isnan(last_move)
+        tails = pd.DataFrame({'ID': tags, 'Count': counts, 'Moved': moved})
+        tails['Tail'] = np.where(moved, starts + counts - np.nan_to_num(last_move) + 1, counts).astype(np.int64)
+        cache.put(key, tails)
+    return tails
+
+
+# Rows of every other day that the full herd run would use as context for the tag's rows of
+# day i: {day: rows} taken from the end of earlier days and the start of later ones
+def _context_rows(tails, i, tag, left, right):
+    context = {}
+    need, moved = max(left, KINEMATICS_CONTEXT), False
+    for k in range(i - 1, -1, -1):
+        if need <= 0 and moved:
+            break
+        count, tail, moved_k = tails[k].get(tag, (0, 0, False))
+        take = min(count, max(need, 0 if moved else tail))
+        if take:
+            context[k] = take
+        need -= take
+        moved = moved or moved_k
+    need = right
+    for k in range(i + 1, len(tails)):
+        if need <= 0:
+            break
+        take = min(tails[k].get(tag, (0, 0, False))[0], need)
+        if take:
+            context[k] = take
+        need -= take
+    return context
+
+
+# Rows of the given tags, sorted by (ID, Timestamp); with `last`/`first` ({tag: rows}) only
+# that many rows per tag from the end/start
+def _tag_rows(filename, tags, last=None, first=None):
+    arrays = load_FA_arrays(filename, FA_COLUMNS)
+    rows = np.flatnonzero(np.isin(arrays['ID'], tags))
+    rows = rows[np.lexsort((arrays['Timestamp'][rows], arrays['ID'][rows]))]
+    frame = _frame(arrays, rows)
+    if last is not None:
+        frame = frame[frame.groupby('ID', sort=False).cumcount(ascending=False) < frame['ID'].map(last)]
+    if first is not None:
+        frame = frame[frame.groupby('ID', sort=False).cumcount() < frame['ID'].map(first)]
+    return frame
+
+
+# Kinematics and spike removal of the given tags for day i; `context` gives each tag's
+# {day: rows} of the other days (_context_rows)
+def _compute_day(filenames, i, tags, context, spike_threshold, kernel_size, mode):
+    parts = [_tag_rows(filenames[i], tags).assign(_day=True)]
+    for k in sorted({k for tag in tags for k in context[tag]}):
+        takes = {tag: context[tag][k] for tag in tags if k in context[tag]}
+        ends = {'last': takes} if k < i else {'first': takes}
+        parts.append(_tag_rows(filenames[k], list(takes), **ends).assign(_day=False))
+    data = pd.concat(parts, ignore_index=True)
+    order = np.lexsort((data['Timestamp'].to_numpy(), data['ID'].to_numpy()))
+    data = calculate_herd_kinematics(data.iloc[order].reset_index(drop=True))
+    fixed, spikes = remove_herd_spikes(data, spike_threshold, kernel_size, mode)
+    data['Y_fixed'] = fixed
+    data['Spike'] = spikes
+    return data[data['_day']].drop(columns='_day')
+
+
+def incremental_pipeline(filenames, cache, spike_threshold=200, kernel_size=41, mode='zero',
+                         y_range_threshold=2600, output_files=None):
+    """Herd kinematics and spike removal over time-ordered daily FA files, per (tag, day).
+
+    Partitions already in `cache` are reused and only new or changed ones are computed.
+    Returns {filename: results of that day}, for the files in output_files (default all);
+    pass output_files=[] to only bring the cache up to date.
+    """
+    filenames = list(filenames)
+    output_files = filenames if output_files is None else list(output_files)
+    hashes = [cache.file_hash(f) for f in filenames]
+    stationary = stationary_tags(filenames, cache, y_range_threshold)
+    print("Stationary Tags Removed: ", len(stationary))
+    params = {'spike_threshold': spike_threshold, 'kernel_size': kernel_size, 'mode': mode}
+    left, right = window_extent(kernel_size)
+    tails = [{int(tag): (int(count), int(tail), bool(moved))
+              for tag, count, tail, moved in file_tails(f, cache)[['ID', 'Count', 'Tail', 'Moved']].itertuples(index=False)}
+             for f in filenames]
+
+    results = {}
+    for i, filename in enumerate(filenames):
+        tags = file_extent(filename, cache)['ID'].to_numpy()
+        tags = tags[~np.isin(tags, stationary)]
+        context = {int(tag): _context_rows(tails, i, int(tag), left, right) for tag in tags}
+        keys = {tag: cache.key(hashes[i], [[k - i, hashes[k], rows] for k, rows in sorted(rows_of_day.items())],
+                               tag, STAGE, params)
+                for tag, rows_of_day in context.items()}
+
+        parts, missing = {}, []
+        for tag, key in keys.items():
+            if filename not in output_files and key in cache:
+                continue
+            part = cache.get(key)
+            if part is None:
+                missing.append(tag)
+            else:
+                parts[tag] = part
+        if missing:
+            print(f"{filename}: computing {len(missing)} of {len(keys)} tags")
+            computed = _compute_day(filenames, i, missing, context, spike_threshold, kernel_size, mode)
+            ids = computed['ID'].to_numpy()
+            bounds = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1], True])
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                part = computed.iloc[start:stop].reset_index(drop=True)
+                cache.put(keys[int(ids[start])], part)
+                parts[int(ids[start])] = part
+        if filename in output_files:
+            results[filename] = pd.concat([parts[tag] for tag in sorted(parts)], ignore_index=True) if parts else pd.DataFrame()
+
+    removed = cache.evict()
+    print(f"Cache: {cache.hits} hits, {cache.misses} misses, {removed} entries evicted")
+    return results
+
+
+if __name__ == "__main__":
+
+    # usage: python result_cache.py CACHE_DIR FA_1.csv [FA_2.csv ...]
+    incremental_pipeline(sys.argv[2:], ResultCache(sys.argv[1]), output_files=[])
@@ -0,0 +1,254 @@
+import heapq
+import numpy as np
+from scipy import ndimage
+
+
+# Edge modes supported by the rolling median:
+#   'zero'    - pad with zeros, reproduces scipy.signal.medfilt (odd kernels) and
+#               MATLAB medfilt1 with its default 'zeropad' (also even kernels)
+#   'nearest' - repeat the first/last sample
+#   'reflect' - mirror the signal at the edges (d c b | a b c d | c b a)
+#   'shrink'  - use only the samples that exist, so windows shrink at the edges
+EDGE_MODES = ('zero', 'nearest', 'reflect', 'shrink')
+
+# Number of windows sorted at once in 'shrink' mode (bounds the temporary memory)
+CHUNK_WINDOWS = 1 << 16
+
+
+# Samples before and after the centre of a window of the given size.
+# Even kernels follow MATLAB medfilt1: x(k-n/2 : k+n/2-1).
+def window_extent(kernel_size):
+    if kernel_size < 1:
+        raise ValueError("kernel_size must be a positive integer.")
+    left = kernel_size // 2
+    right = kernel_size - 1 - left
+    return left, right
+
+
+# Sliding median over a stream: two heaps with lazy deletion, O(log k) per sample.
+# Removed values stay in the heaps until they reach a top; once more of them are stale than
+# live, both heaps are rebuilt from the window so memory stays O(k) on any signal.
+class RollingMedian:
+    def __init__(self, kernel_size=None):
+        self.kernel_size = kernel_size    # None: the caller evicts with remove_oldest()
+        self.low = []       # max-heap (negated) with the smaller half
+        self.high = []      # min-heap with the larger half
+        self.low_size = 0
+        self.high_size = 0
+        self.pending = {}   # values removed from the window but still inside a heap
+        self.stale = 0      # number of such values (sum of pending)
+        self.window = []    # values in the window, oldest first
+        self.start = 0
+
+    def __len__(self):
+        return len(self.window) - self.start
+
+    # Drop heap tops that were already removed from the window
+    def _prune(self, heap, sign):
+        while heap:
+            value = sign * heap[0]
+            count = self.pending.get(value, 0)
+            if count == 0:
+                break
+            if count == 1:
+                del self.pending[value]
+            else:
+                self.pending[value] = count - 1
+            self.stale -= 1
+            heapq.heappop(heap)
+
+    # Rebuild both heaps from the values in the window, dropping every stale entry
+    def _rebuild(self):
+        live = sorted(self.window[self.start:])
+        del self.window[:self.start]
+        self.start = 0
+        self.low_size = (len(live) + 1) // 2
+        self.high_size = len(live) - self.low_size
+        self.low = [-value for value in live[:self.low_size]]
+        heapq.heapify(self.low)
+        self.high = live[self.low_size:]    # sorted, so already a min-heap
+        self.pending = {}
+        self.stale = 0
+
+    # Keep the low half equal to, or one larger than, the high half
+    def _rebalance(self):
+        if self.low_size > self.high_size + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.low_size -= 1
+            self.high_size += 1
+            self._prune(self.low, -1)
+        elif self.low_size < self.high_size:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.high_size -= 1
+            self.low_size += 1
+            self._prune(self.high, 1)
+
+    def add(self, value):
+        value = float(value)
+        if not self.low or value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+            self.low_size += 1
+        else:
+            heapq.heappush(self.high, value)
+            self.high_size += 1
+        self.window.append(value)
+        self._rebalance()
+
+    def remove_oldest(self):
+        value = self.window[self.start]
+        self.start += 1
+        # compact the window list now and then instead of popping from the front
+        if self.start > 64 and self.start * 2 > len(self.window):
+            del self.window[:self.start]
+            self.start = 0
+        self.pending[value] = self.pending.get(value, 0) + 1
+        self.stale += 1
+        if self.low and value <= -self.low[0]:
+            self.low_size -= 1
+            if value == -self.low[0]:
+                self._prune(self.low, -1)
+        else:
+            self.high_size -= 1
+            if self.high and value == self.high[0]:
+                self._prune(self.high, 1)
+        self._rebalance()
+        if self.stale > max(len(self), 16):
+            self._rebuild()
+        return value
+
+    # Add a sample, evicting the oldest one once the window is full, and return the median
+    def push(self, value):
+        self.add(value)
+        if self.kernel_size is not None and len(self) > self.kernel_size:
+            self.remove_oldest()
+        return self.median()
+
+    def median(self):
+        if self.low_size == 0:
+            return np.nan
+        if self.low_size > self.high_size:
+            return -self.low[0]
+        return (-self.low[0] + self.high[0]) / 2.0
+
+
+# Pad one signal for the given edge mode ('shrink' pads with NaN, which is ignored later)
+def _pad(x, left, right, mode):
+    if mode == 'zero':
+        return np.pad(x, (left, right), mode='constant', constant_values=0)
+    if mode == 'nearest':
+        return np.pad(x, (left, right), mode='edge')
+    if mode == 'reflect':
+        if len(x) > 1:
+            return np.pad(x, (left, right), mode='reflect')
+        return np.pad(x, (left, right), mode='edge')
+    if mode == 'shrink':
+        return np.pad(x, (left, right), mode='constant', constant_values=np.nan)
+    raise ValueError(f"Unknown edge mode '{mode}', expected one of {EDGE_MODES}.")
+
+
+# Median of every window of a padded signal, evaluated at padded positions `centres`.
+# Full windows use SciPy's compiled rank filter (an even kernel averages its two middle
+# ranks like MATLAB medfilt1). In 'shrink' mode only the windows that reach into the NaN
+# padding (the first `left` and last `right` of every segment) are sorted, skipping the
+# NaNs; all other windows are full and go through the rank filter as well.
+def _medians_at(padded, centres, kernel_size, shrink):
+    left, right = window_extent(kernel_size)
+    if not shrink:
+        lo, hi = (kernel_size - 1) // 2, kernel_size // 2
+        # ndimage already places even windows at x(k-n/2 : k+n/2-1)
+        median = ndimage.rank_filter(padded, lo, kernel_size, mode='constant')
+        if hi != lo:
+            median = 0.5 * (median + ndimage.rank_filter(padded, hi, kernel_size, mode='constant'))
+        return median[centres]
+
+    missing = np.isnan(padded)
+    missing_before = np.r_[0, np.cumsum(missing)]
+    shrunk = missing_before[centres + right + 1] > missing_before[centres - left]
+    out = np.empty(len(centres), dtype=np.float64)
+    # the rank filter never sees a NaN; full windows do not contain the zeroed samples
+    out[~shrunk] = _medians_at(np.where(missing, 0.0, padded), centres[~shrunk], kernel_size, False)
+
+    shrunk_at = np.flatnonzero(shrunk)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, kernel_size)
+    for i in range(0, len(shrunk_at), CHUNK_WINDOWS):
+        rows = shrunk_at[i:i + CHUNK_WINDOWS]
+        block = windows[centres[rows] - left]
+        ordered = np.sort(block, axis=1)
+        count = np.sum(~np.isnan(block), axis=1)
+        lo = ((count - 1) // 2)[:, None]
+        hi = (count // 2)[:, None]
+        out[rows] = 0.5 * (np.take_along_axis(ordered, lo, axis=1)
+                           + np.take_along_axis(ordered, hi, axis=1))[:, 0]
+    return out
+
+
+# Two-heap rolling median; window i covers padded[i:i+k], or the clipped
+# x[i-left:i+right+1] in 'shrink' mode
+def _rolling_median_heap(x, padded, kernel_size, mode):
+    n = len(x)
+    left, right = window_extent(kernel_size)
+    if mode == 'shrink':
+        values = x
+        lows = np.maximum(np.arange(n) - left, 0)
+        highs = np.minimum(np.arange(n) + right, n - 1)
+    else:
+        values = padded
+        lows = np.arange(n)
+        highs = lows + kernel_size - 1
+
+    engine = RollingMedian()
+    out = np.empty(n, dtype=np.float64)
+    added = removed = 0
+    for i in range(n):
+        while added <= highs[i]:
+            engine.add(values[added])
+            added += 1
+        while removed < lows[i]:
+            engine.remove_oldest()
+            removed += 1
+        out[i] = engine.median()
+    return out
+
+
+# Rolling median of a 1-D signal.
+# method='rank' uses the compiled rank filter (fastest for batch work),
+# method='heap' runs the O(n log k) two-heap RollingMedian over the padded signal.
+def rolling_median(x, kernel_size=41, mode='zero', method='rank'):
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0:
+        return x.copy()
+    left, right = window_extent(kernel_size)
+    padded = _pad(x, left, right, mode)
+
+    if method == 'heap':
+        return _rolling_median_heap(x, padded, kernel_size, mode)
+    if method != 'rank':
+        raise ValueError(f"Unknown method '{method}', expected 'rank' or 'heap'.")
+
+    return _medians_at(padded, left + np.arange(len(x)), kernel_size, mode == 'shrink')
+
+
+# Rolling median of many concatenated signals (e.g. all tags of a herd sorted by ID),
+# where `starts` marks the first sample of every segment. Windows never cross a
+# segment boundary; each segment gets its own edge handling.
+def segmented_rolling_median(x, starts, kernel_size=41, mode='zero'):
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n == 0:
+        return x.copy()
+    left, right = window_extent(kernel_size)
+    bounds = np.append(np.flatnonzero(starts), n)
+    if bounds[0] != 0:
+        bounds = np.insert(bounds, 0, 0)
+
+    # pad every segment on its own and remember where its samples land in the padded signal
+    pieces = []
+    centres = np.empty(n, dtype=np.int64)
+    offset = 0
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        pieces.append(_pad(x[s:e], left, right, mode))
+        centres[s:e] = offset + left + np.arange(e - s)
+        offset += e - s + left + right
+    padded = np.concatenate(pieces)
+
+    return _medians_at(padded, centres, kernel_size, mode == 'shrink')
@@ -1,16 +1,104 @@
+import os
+import json
 import time
+import weakref
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.signal import medfilt
+from rolling_median import rolling_median, segmented_rolling_median
+from render import raster_combined_plots, raster_angular_plots
+from instrumentation import instrumented
+from quantile_sketch import KinematicsSketches
 import numpy as np
-import math
 
 
-# Read and parse the CSV file, assigning proper column names
-def read_FA_file(filename):
+# Columns kept in the on-disk cache and the narrow dtypes they are stored with
+# (Column1 and Column3 are never used by the analysis and are dropped)
+FA_CACHE_DTYPES = {
+    'ID': np.int64,
+    'Timestamp': np.int64,     # milliseconds since epoch
+    'X': np.int32,
+    'Y': np.int32,
+    'Z': np.int32,
+}
+FA_CACHE_VERSION = 1
+
+
+# Location of the column cache for an FA file: <dir>/.fa_cache/<basename>/
+def fa_cache_path(filename, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), '.fa_cache')
+    return os.path.join(cache_dir, os.path.basename(filename))
+
+
+# Check that the cache exists and was built from the current version of the CSV
+def _fa_cache_is_valid(filename, cache_path):
+    meta_file = os.path.join(cache_path, 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(filename)
+    return (meta.get('version') == FA_CACHE_VERSION
+            and meta.get('size') == stat.st_size
+            and meta.get('mtime_ns') == stat.st_mtime_ns
+            and all(os.path.exists(os.path.join(cache_path, col + '.npy')) for col in FA_CACHE_DTYPES))
+
+
+# Parse the CSV once and store every kept column as its own .npy file. If the cache cannot
+# be written (read-only data directory, full disk) the parsed columns are still returned.
+def _write_fa_cache(filename, cache_path):
+    stat = os.stat(filename)
+    df = pd.read_csv(filename, header=None, usecols=[1, 3, 4, 5, 6])
+    df.columns = ['ID', 'Timestamp', 'X', 'Y', 'Z']
+    arrays = {col: df[col].to_numpy().astype(dtype) for col, dtype in FA_CACHE_DTYPES.items()}
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        for col, values in arrays.items():
+            # write to a temporary name first so a crashed run never leaves a half-written column
+            tmp_file = os.path.join(cache_path, col + '.tmp.npy')
+            np.save(tmp_file, values)
+            os.replace(tmp_file, os.path.join(cache_path, col + '.npy'))
+        meta = {'version': FA_CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'rows': len(df)}
+        with open(os.path.join(cache_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    except OSError as e:
+        print(f"Could not write the FA cache for {filename} ({e}); using the parsed CSV")
+    return arrays
+
+
+# Load (a subset of) the cached columns of an FA file as memory-mapped arrays,
+# building the cache from the CSV first if it is missing or out of date
+def load_FA_arrays(filename, columns=None, cache_dir=None):
+    if columns is None:
+        columns = list(FA_CACHE_DTYPES)
+    unknown = [col for col in columns if col not in FA_CACHE_DTYPES]
+    if unknown:
+        raise ValueError(f"Columns not available in the FA cache: {unknown}")
+
+    cache_path = fa_cache_path(filename, cache_dir)
+    if not _fa_cache_is_valid(filename, cache_path):
+        arrays = _write_fa_cache(filename, cache_path)
+        return {col: arrays[col] for col in columns}
+    return {col: np.load(os.path.join(cache_path, col + '.npy'), mmap_mode='r') for col in columns}
+
+
+# Read and parse the CSV file, assigning proper column names.
+# With use_cache=True the typed column cache is used (and built on the first read);
+# only ID, Timestamp, X, Y and Z are returned in that case.
+@instrumented('read_FA_file')
+def read_FA_file(filename, columns=None, use_cache=True, cache_dir=None):
     try:
+        if use_cache:
+            # copy out of the read-only memory maps so the frame can be modified as before
+            arrays = load_FA_arrays(filename, columns, cache_dir)
+            return pd.DataFrame(arrays)
         df = pd.read_csv(filename, header=None)
         df.columns = ['Column1', 'ID', 'Column3', 'Timestamp', 'X', 'Y', 'Z']
+        if columns is not None:
+            df = df[columns]
         return df
     except FileNotFoundError:
         print(f"The file {filename} was not found.")
@@ -19,14 +107,138 @@ def read_FA_file(filename):
         print(f"An error occurred: {e}")
         return None
 
-# Filter data by a specific individual's ID
+# Index over FA data sorted by (ID, Timestamp) with a per-tag offset table,
+# so that tag and time-window lookups are binary searches returning slices
+class FAIndex:
+    def __init__(self, data):
+        # stable sort keeps the file order of samples that share a timestamp
+        order = np.lexsort((data['Timestamp'].to_numpy(), data['ID'].to_numpy()))
+        self.data = data.iloc[order].reset_index(drop=True)
+        ids = self.data['ID'].to_numpy()
+        self.tags, starts = np.unique(ids, return_index=True)
+        self.offsets = np.append(starts, len(ids))
+        self.timestamps = _timestamps_as_ms(self.data['Timestamp'])
+
+    def __len__(self):
+        return len(self.data)
+
+    # Row range [start, stop) of one tag, or (0, 0) if the tag is not present
+    def tag_bounds(self, individual_id):
+        i = np.searchsorted(self.tags, individual_id)
+        if i == len(self.tags) or self.tags[i] != individual_id:
+            return 0, 0
+        return self.offsets[i], self.offsets[i + 1]
+
+    # All samples of one tag (a slice of the sorted frame, no copy)
+    def individual(self, individual_id):
+        start, stop = self.tag_bounds(individual_id)
+        return self.data.iloc[start:stop]
+
+    # Samples of one tag inside [start_time, end_time]
+    def query(self, individual_id, start_time, end_time):
+        start, stop = self.tag_bounds(individual_id)
+        lo, hi = _interval_bounds(self.timestamps[start:stop], start_time, end_time)
+        return self.data.iloc[start + lo:start + hi]
+
+    # Samples of every tag inside [start_time, end_time], still sorted by (ID, Timestamp)
+    def interval(self, start_time, end_time):
+        pieces = []
+        for i in range(len(self.tags)):
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            lo, hi = _interval_bounds(self.timestamps[start:stop], start_time, end_time)
+            if hi > lo:
+                pieces.append(np.arange(start + lo, start + hi))
+        rows = np.concatenate(pieces) if pieces else np.array([], dtype=np.int64)
+        return self.data.iloc[rows]
+
+
+# Build the (ID, Timestamp) index once after loading
+@instrumented('build_FA_index')
+def build_FA_index(data):
+    return FAIndex(data)
+
+
+# Timestamps as int64 milliseconds, whether stored as raw ms or as datetimes
+def _timestamps_as_ms(timestamps):
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return timestamps.to_numpy().astype('datetime64[ms]').astype(np.int64)
+    return timestamps.to_numpy().astype(np.int64)
+
+
+# Positions [lo, hi) of the sorted ms timestamps that fall inside [start_time, end_time]
+def _interval_bounds(timestamps_ms, start_time, end_time):
+    start_ms = pd.to_datetime(start_time).value // 10**6
+    end_ms = pd.to_datetime(end_time).value // 10**6
+    lo = np.searchsorted(timestamps_ms, start_ms, side='left')
+    hi = np.searchsorted(timestamps_ms, end_ms, side='right')
+    return lo, hi
+
+
+# Row positions of every tag of the plain DataFrames passed to get_individual, keyed by
+# id(frame) and dropped with the frame: (weak reference, ID column fingerprint, tag rows).
+# The tag rows are only built on the second lookup, so a single call costs no more than a
+# mask. Replacing the ID column (or the frame's length) invalidates them; editing ID values
+# in place does not.
+_tag_rows_cache = {}
+
+
+def _cached_tag_rows(data):
+    ids = data['ID'].to_numpy()
+    fingerprint = (len(ids), ids.__array_interface__['data'][0], ids.strides)
+    key = id(data)
+    cached = _tag_rows_cache.get(key)
+    if cached is None or cached[0]() is not data or cached[1] != fingerprint:
+        ref = weakref.ref(data, lambda _, key=key: _tag_rows_cache.pop(key, None))
+        _tag_rows_cache[key] = (ref, fingerprint, None)
+        return None
+    if cached[2] is None:
+        # rows of each tag in frame order, like the mask; a stable sort of narrow tag codes
+        # is a radix sort
+        codes, tags = pd.factorize(ids, sort=True)
+        codes = codes.astype(np.int16 if len(tags) < 2**15 else np.int32)
+        order = np.argsort(codes, kind='stable')
+        offsets = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(tags)))]
+        _tag_rows_cache[key] = cached = (cached[0], fingerprint, (np.asarray(tags), offsets, order))
+    return cached[2]
+
+
+# Filter data by a specific individual's ID.
+# An FAIndex (build_FA_index) gives a slice by binary search. A plain DataFrame, such as the
+# output of read_FA_file, is masked on the first call; from the second call on the same
+# frame its per-tag row positions are reused, and the rows come back in the same order.
+@instrumented('get_individual')
 def get_individual(data, individual_id):
-    return data[data['ID'] == individual_id]
-
-
-# Get data within a specified time interval
+    if isinstance(data, FAIndex):
+        return data.individual(individual_id)
+    tag_rows = _cached_tag_rows(data)
+    if tag_rows is None:
+        return data[data['ID'] == individual_id]
+    tags, offsets, order = tag_rows
+    i = np.searchsorted(tags, individual_id)
+    if i == len(tags) or tags[i] != individual_id:
+        return data.iloc[order[:0]]
+    return data.iloc[order[offsets[i]:offsets[i + 1]]]
+
+
+# Get data within a specified time interval.
+# An FAIndex or a DataFrame whose Timestamp column is non-decreasing (one tag of an FAIndex,
+# or a single FA file, which is in time order) is cut by binary search. Any other DataFrame,
+# e.g. several files concatenated out of order, falls back to converting and masking every row.
+@instrumented('get_interval')
 def get_interval(data, start_time, end_time):
     try:
+        if isinstance(data, FAIndex):
+            data = data.interval(start_time, end_time)
+            return data.assign(Timestamp=pd.to_datetime(data['Timestamp'], unit='ms'))
+
+        # Time-sorted data (e.g. one tag from an FAIndex): binary search instead of a full mask
+        if data['Timestamp'].is_monotonic_increasing:
+            lo, hi = _interval_bounds(_timestamps_as_ms(data['Timestamp']), start_time, end_time)
+            data = data.iloc[lo:hi]
+            if pd.api.types.is_datetime64_any_dtype(data['Timestamp']):
+                return data.copy()
+            return data.assign(Timestamp=pd.to_datetime(data['Timestamp'], unit='ms'))
+
         data['Timestamp'] = pd.to_datetime(data['Timestamp'], unit='ms')
         mask = (data['Timestamp'] >= pd.to_datetime(start_time)) & (data['Timestamp'] <= pd.to_datetime(end_time))
         return data.loc[mask]
@@ -35,16 +247,105 @@ def get_interval(data, start_time, end_time):
         return pd.DataFrame()
 
 
-# Remove spikes from the signal and return both the cleaned signal and the locations of the spikes
-def remove_spikes_and_identify(y_data, spike_threshold):
-    median_signal = medfilt(y_data, kernel_size=41)  # Using median filter to smooth the signal
+# Remove spikes from the signal and return both the cleaned signal and the locations of the spikes.
+# The default kernel and 'zero' edge mode reproduce scipy.signal.medfilt(kernel_size=41).
+@instrumented('remove_spikes_and_identify')
+def remove_spikes_and_identify(y_data, spike_threshold, kernel_size=41, mode='zero'):
+    median_signal = rolling_median(y_data, kernel_size, mode)  # Using median filter to smooth the signal
+    return _replace_spikes(y_data, median_signal, spike_threshold, kernel_size)
+
+
+# Row order that sorts herd data by (ID, Timestamp), or None when it is already sorted
+def _tag_time_order(data):
+    ids = data['ID'].to_numpy()
+    ts = _timestamps_as_ms(data['Timestamp'])
+    id_step = np.diff(ids)
+    if np.all((id_step > 0) | ((id_step == 0) & (np.diff(ts) >= 0))):
+        return None
+    return np.lexsort((ts, ids))
+
+
+# Spike removal for every tag of herd data in one call; the median window never crosses
+# from one tag into the next. Unsorted rows (e.g. read_FA_file output, in time order) are
+# filtered in (ID, Timestamp) order and the results returned aligned to the input rows.
+@instrumented('remove_herd_spikes')
+def remove_herd_spikes(data, spike_threshold, kernel_size=41, mode='zero', column='Y'):
+    if isinstance(data, FAIndex):
+        data = data.data
+    order = _tag_time_order(data)
+    y_data = data[column] if order is None else data[column].iloc[order]
+    starts = _tag_starts(data['ID'].to_numpy() if order is None else data['ID'].to_numpy()[order])
+    median_signal = segmented_rolling_median(y_data, starts, kernel_size, mode)
+    fixed, spikes = _replace_spikes(y_data, median_signal, spike_threshold, kernel_size)
+    if order is not None:
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        fixed, spikes = fixed.iloc[inverse], spikes.iloc[inverse]
+    return fixed, spikes
+
+
+def _replace_spikes(y_data, median_signal, spike_threshold, kernel_size):
+    fixed_y_data = y_data.copy()
+    if np.issubdtype(np.asarray(y_data).dtype, np.integer):
+        if kernel_size % 2:
+            # odd windows pick an actual sample, keep the integer type like medfilt does
+            median_signal = median_signal.astype(np.asarray(y_data).dtype)
+        else:
+            fixed_y_data = fixed_y_data.astype(np.float64)
     diff_signal = abs(y_data - median_signal)
     spikes = diff_signal > spike_threshold
-    fixed_y_data = y_data.copy()
     fixed_y_data[spikes] = median_signal[spikes]
     return fixed_y_data, spikes
 
 
+# Joint spike removal on several axes of herd data. All axes of all tags go through one
+# segmented rolling median (every axis of every tag is its own segment); a sample is a spike
+# when its Euclidean distance from the median track is above spike_threshold, and then all
+# of its axes are replaced by their medians. Rows are filtered in (ID, Timestamp) order;
+# the results are aligned to the input rows.
+@instrumented('remove_herd_spikes_multiaxis')
+def remove_herd_spikes_multiaxis(data, spike_threshold, kernel_size=41, mode='zero', axes=('X', 'Y')):
+    if isinstance(data, FAIndex):
+        data = data.data
+    axes = list(axes)
+    n = len(data)
+    order = _tag_time_order(data)
+    rows = slice(None) if order is None else order
+    values = np.concatenate([data[axis].to_numpy(dtype=np.float64)[rows] for axis in axes])
+    starts = np.tile(_tag_starts(data['ID'].to_numpy()[rows]), len(axes))
+    starts[::n or 1] = True
+    medians = segmented_rolling_median(values, starts, kernel_size, mode).reshape(len(axes), n)
+    deviation = np.sqrt(((values.reshape(len(axes), n) - medians) ** 2).sum(axis=0))
+    if order is not None:
+        # back to the input row order
+        medians[:, order] = medians.copy()
+        deviation[order] = deviation.copy()
+    spikes = pd.Series(deviation > spike_threshold, index=data.index)
+
+    fixed = pd.DataFrame(index=data.index)
+    for axis, median_signal in zip(axes, medians):
+        column = data[axis]
+        if np.issubdtype(column.dtype, np.integer) and kernel_size % 2:
+            # odd windows pick an actual sample, keep the integer type like medfilt does
+            median_signal = median_signal.astype(column.dtype)
+        fixed[axis] = np.where(spikes, median_signal, column.to_numpy())
+    return fixed, spikes
+
+
+# Herd data with spikes removed from X, Y (and optionally Z) before the kinematics, so
+# velocity, acceleration and heading are computed from the cleaned track. The raw
+# coordinates are kept as X_raw, Y_raw, ... and the spike flags as Spike.
+def clean_herd_positions(data, spike_threshold, kernel_size=41, mode='zero', axes=('X', 'Y')):
+    data = _sorted_by_tag_and_time(data)
+    fixed, spikes = remove_herd_spikes_multiaxis(data, spike_threshold, kernel_size, mode, axes)
+    for axis in axes:
+        data[axis + '_raw'] = data[axis]
+        data[axis] = fixed[axis]
+    data['Spike'] = spikes
+    return data
+
+
+@instrumented('calculate_velocity')
 def calculate_velocity(data):
     # Convert the 'Timestamp' column to datetime format for time operations
     data['Timestamp'] = pd.to_datetime(data['Timestamp'])
@@ -62,6 +363,7 @@ def calculate_velocity(data):
     return data
 
 
+@instrumented('calculate_acceleration')
 def calculate_acceleration(data): 
     # Calculate acceleration using the velocity difference
     data['Acceleration'] = data['Velocity'].diff() / data['TimeDiff']
@@ -71,59 +373,167 @@ def calculate_acceleration(data):
     return data
 
 
+# Heading, its cosine, turning angle and angular velocity from the X/Y track.
+# `starts` marks the first sample of every tag; nothing is carried across a tag start.
+def _angular_columns(x, y, time_diff, starts):
+    dx = _segmented_diff(x, starts)
+    dy = _segmented_diff(y, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = dy / dx
+
+    # heading in degrees, (-180, 180]; a sample without movement keeps the previous heading
+    heading = np.degrees(np.arctan2(dy, dx))
+    heading[(dx == 0) & (dy == 0)] = np.nan
+    known = ~np.isnan(heading) | starts
+    heading = heading[np.maximum.accumulate(np.where(known, np.arange(len(heading)), 0))]
+    heading = np.nan_to_num(heading, nan=0.0)
+
+    # turning angle wrapped to [-180, 180)
+    turn = np.nan_to_num((_segmented_diff(heading, starts) + 180.0) % 360.0 - 180.0, nan=0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angular_velocity = turn / time_diff
+    angular_velocity = np.nan_to_num(angular_velocity, nan=0.0, posinf=0.0, neginf=0.0)
+
+    return {
+        'Slope': np.nan_to_num(slope, nan=0.0, posinf=np.inf, neginf=-np.inf),
+        'Theta': heading,
+        'Cosine': np.cos(np.radians(heading)),
+        'Theta_diff': turn,
+        'Angular_velocity': angular_velocity,    # degrees per second
+    }
+
+
+# Time between consecutive samples in seconds, from TimeDiff if calculate_velocity already ran
+def _time_diff(data, starts):
+    if 'TimeDiff' in data.columns:
+        return data['TimeDiff'].to_numpy(dtype=np.float64)
+    return _segmented_diff(_timestamps_as_ms(data['Timestamp']), starts) / 1000.0
+
+
+@instrumented('calculate_angular_observables')
 def calculate_angular_observables(data):
+    starts = np.zeros(len(data), dtype=bool)
+    starts[:1] = True
+    for col, values in _angular_columns(data['X'], data['Y'], _time_diff(data, starts), starts).items():
+        data[col] = values
+    return data
+
+
+# Herd-wide kinematics: the same quantities as calculate_velocity, calculate_acceleration
+# and calculate_angular_observables, computed for all tags in one vectorized pass.
+# Diffs are reset at tag boundaries, so every tag starts like a single-individual run.
+
+# Mark the first row of every tag in (ID, Timestamp)-sorted data
+def _tag_starts(ids):
+    starts = np.ones(len(ids), dtype=bool)
+    starts[1:] = ids[1:] != ids[:-1]
+    return starts
+
+
+# Difference to the previous sample, NaN on the first sample of every tag
+def _segmented_diff(values, starts):
+    values = np.asarray(values, dtype=np.float64)
+    out = np.empty_like(values)
+    out[0:1] = np.nan
+    np.subtract(values[1:], values[:-1], out=out[1:])
+    out[starts] = np.nan
+    return out
+
+
+# Make sure every tag is contiguous and time-sorted, sorting only if needed
+def _sorted_by_tag_and_time(data):
+    if isinstance(data, FAIndex):
+        return data.data.copy()
+    if _tag_time_order(data) is None:
+        return data.copy()
+    return FAIndex(data).data
+
+
+@instrumented('calculate_herd_velocity')
+def calculate_herd_velocity(data):
+    data = _sorted_by_tag_and_time(data)
+    starts = _tag_starts(data['ID'].to_numpy())
+    # Time difference in seconds (raw timestamps are milliseconds)
+    data['TimeDiff'] = _segmented_diff(_timestamps_as_ms(data['Timestamp']), starts) / 1000.0
+    data['X_diff'] = _segmented_diff(data['X'], starts)
+    data['Y_diff'] = _segmented_diff(data['Y'], starts)
+    data['Velocity'] = np.sqrt(data['X_diff']**2 + data['Y_diff']**2) / data['TimeDiff']
+    data['Velocity'] = data['Velocity'].fillna(0)
+    return data
+
+
+# Expects the output of calculate_herd_velocity
+@instrumented('calculate_herd_acceleration')
+def calculate_herd_acceleration(data):
+    starts = _tag_starts(data['ID'].to_numpy())
+    data['Acceleration'] = _segmented_diff(data['Velocity'], starts) / data['TimeDiff']
+    data['Acceleration'] = data['Acceleration'].fillna(0)
+    return data
 
-    # Calculate slope
-    data['Slope'] = data['Y'].diff() / data['X'].diff()
-    data['Slope'] = data['Slope'].fillna(0)
 
-    # Calculate angle theta
-    data['Theta'] = data['Slope'].apply(lambda slope: math.atan(slope) if not math.isnan(slope) else None)
-    data['Theta'] = np.degrees(data['Theta'])
-    data['Theta'] = data['Theta'].fillna(0)
-    data['Cosine'] = data['Theta'].apply(lambda theta: math.cos(theta) if not math.isnan(theta) else None)
+@instrumented('calculate_herd_angular_observables')
+def calculate_herd_angular_observables(data):
+    starts = _tag_starts(data['ID'].to_numpy())
+    for col, values in _angular_columns(data['X'], data['Y'], _time_diff(data, starts), starts).items():
+        data[col] = values
+    return data
 
-    data['Theta_diff'] = data['Theta'].diff()
-    data['Theta_diff'] = data['Theta_diff'].fillna(0)
 
+# Velocity, acceleration and angular observables for every tag at once
+@instrumented('calculate_herd_kinematics')
+def calculate_herd_kinematics(data):
+    data = calculate_herd_velocity(data)
+    data = calculate_herd_acceleration(data)
+    data = calculate_herd_angular_observables(data)
     return data
 
 
 # detect and drop inactive tags
-def detect_drop_inactive_tags(df):
-    """Detect and drop stationary tags."""
-    
+@instrumented('detect_drop_inactive_tags')
+def detect_drop_inactive_tags(df, y_range_threshold=2600, xz_range_threshold=None, return_report=False):
+    """Detect and drop stationary tags.
+
+    A tag is stationary when its Y range is at most y_range_threshold (mm). If
+    xz_range_threshold is given, the tag must also move at most that much in X and Z.
+    With return_report=True a per-tag table of X/Y/Z ranges is returned as well.
+    """
+
     print("Removing Stationary Tags.")
-    
-    # get unique cow tags
-    unique_tags = df.ID.unique()
-    to_drop = []
 
-    # loop over ucows, find stationary tags
-    for tag in unique_tags:
-        temp = get_individual(df, tag)
-        
-        x = list(temp['X'])
-        y = list(temp['Y'])
-        z = list(temp['Z'])
-        
-        # save stationary tags to a list
-        if abs(max(y)-min(y)) <= 2600:          # only check y-direction
-            to_drop.append(tag)
-    
-    # drop stationary tags from the data
-    for i in range(len(to_drop)):
-        # print("Dropping Stationary Tag: ", cow)
-        indexID = df[df.ID == to_drop[i]].index
-        df = df.drop(indexID) # drop tags
-    
+    # per-tag min/max of every coordinate in one grouped pass
+    extent = df.groupby('ID', sort=False)[['X', 'Y', 'Z']].agg(['min', 'max'])
+    report = pd.DataFrame({
+        'X_range': extent[('X', 'max')] - extent[('X', 'min')],
+        'Y_range': extent[('Y', 'max')] - extent[('Y', 'min')],
+        'Z_range': extent[('Z', 'max')] - extent[('Z', 'min')],
+    })
+
+    # save stationary tags (only the y-direction unless x/z are requested)
+    stationary = report['Y_range'].abs() <= y_range_threshold
+    if xz_range_threshold is not None:
+        stationary &= (report['X_range'].abs() <= xz_range_threshold) & (report['Z_range'].abs() <= xz_range_threshold)
+    report['Stationary'] = stationary
+    to_drop = report.index[stationary]
+
+    # drop stationary tags from the data with a single mask
+    df = df[~df['ID'].isin(to_drop)]
+
     print("Stationary Tags Removed: ", len(to_drop))
 
+    if return_report:
+        return df, report
     return df
 
 
 # Plotting Quantities
-def combined_plots(interval_data, fixed_signal, spikes, velocity_threshold, acc_threshold):
+# raster=True draws pre-aggregated density rasters and histograms (see render.py),
+# which keeps the drawing time independent of the number of rows
+@instrumented('combined_plots')
+def combined_plots(interval_data, fixed_signal, spikes, velocity_threshold, acc_threshold,
+                   output_file="com_plot.png", raster=False):
+    if raster:
+        return raster_combined_plots(interval_data, fixed_signal, spikes, velocity_threshold, acc_threshold, output_file)
+
     # Set up a grid of plots with 2 rows and 3 columns
     # The first row for the original and cleaned signals, and velocity distribution
     # The second row for the scatter plots with original and cleaned data, and highlighted speeds
@@ -192,12 +602,18 @@ def combined_plots(interval_data, fixed_signal, spikes, velocity_threshold, acc_
     axs[1, 3].legend()
 
     plt.tight_layout()
-    plt.savefig("com_plot.png")
+    plt.savefig(output_file)
+    plt.close(fig)
+    return output_file
 
 
-def angular_plots(data, spikes):
+@instrumented('angular_plots')
+def angular_plots(data, spikes, output_file="ang_plot.png", raster=False):
     """Plot angular quantities with or without spikes."""
-    
+
+    if raster:
+        return raster_angular_plots(data, output_file)
+
     fig, axs = plt.subplots(1, 4, figsize=(16, 4))
 
     # Theta Distribution
@@ -230,7 +646,9 @@ def angular_plots(data, spikes):
 
     # Adjust layout and save figure.
     plt.tight_layout()
-    plt.savefig("ang_plot.png")
+    plt.savefig(output_file)
+    plt.close(fig)
+    return output_file
 
     
 def main():
@@ -266,6 +684,9 @@ def main():
         
         # Remove Stationary Tags
         data = detect_drop_inactive_tags(data)
+
+        # Sort by (ID, Timestamp) once so lookups are binary searches
+        data = build_FA_index(data)
                
         # Benchmark: Start Time
         starttime = time.time()
@@ -277,14 +698,18 @@ def main():
         data = calculate_angular_observables(data)
         fixed_signal, spikes = remove_spikes_and_identify(data['Y'], spike_threshold)
 
+        # Thresholds from per-(tag, day) quantile sketches, which can also be saved and
+        # merged with those of other days (see quantile_sketch.py)
+        sketches = KinematicsSketches().update(data)
+
         # Ensure 'Velocity' column exists before trying to access it
         if 'Velocity' in data.columns:
-            velocity_threshold = np.percentile(data['Velocity'], 95)
+            velocity_threshold = sketches.percentile('Velocity', 95)
             print(f"The calculated velocity threshold is: {velocity_threshold}")
 
         # Ensure 'Acceleration' column exists before trying to access it
         if 'Acceleration' in data.columns:
-            acceleration_threshold = np.percentile(data['Acceleration'], 95)
+            acceleration_threshold = sketches.percentile('Acceleration', 95)
             print(f"The calculated acceleration threshold is: {acceleration_threshold}")
         
         # Benchmark: Elapsed Time
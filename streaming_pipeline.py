@@ -0,0 +1,177 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from rolling_median import window_extent, segmented_rolling_median
+from spikes_medfilt_v2 import (FA_CACHE_DTYPES, fa_cache_path, _fa_cache_is_valid, load_FA_arrays,
+                               calculate_herd_kinematics, _tag_starts, _replace_spikes, remove_herd_spikes_multiaxis)
+from quantile_sketch import KinematicsSketches
+
+
+# Bounded-memory version of the pipeline: FA files are read in chunks and every chunk goes
+# through stationary-tag filtering, herd kinematics and spike removal. Only a few samples
+# per tag are carried from one chunk to the next, so memory does not grow with the number
+# of days. The output matches calculate_herd_kinematics + remove_herd_spikes on the
+# concatenated files (rows are written per chunk, sort by ID and Timestamp to compare).
+# Velocity and acceleration are folded into per-(tag, day) quantile sketches as they are
+# computed, which give the thresholds at the end without keeping the columns.
+# With clean_axes the order of the two stages is swapped: spikes are removed jointly from
+# those axes first and the kinematics run on the cleaned rows as they become ready, which
+# matches calculate_herd_kinematics(clean_herd_positions(...)).
+
+FA_COLUMNS = list(FA_CACHE_DTYPES)
+
+# Raw samples kept per tag for the kinematics: velocity and heading of the last sample
+# need the one before it, and acceleration / turning of the next chunk need both
+KINEMATICS_CARRY = 2
+
+
+# Yield the ID/Timestamp/X/Y/Z rows of an FA file in chunks, from the column cache
+# if it is already built (memory-mapped slices) and from the CSV otherwise
+def iter_FA_chunks(filename, chunksize=500000, cache_dir=None):
+    if _fa_cache_is_valid(filename, fa_cache_path(filename, cache_dir)):
+        arrays = load_FA_arrays(filename, FA_COLUMNS, cache_dir)
+        for start in range(0, len(arrays['ID']), chunksize):
+            yield pd.DataFrame({col: np.array(arrays[col][start:start + chunksize]) for col in FA_COLUMNS})
+        return
+    for chunk in pd.read_csv(filename, header=None, usecols=[1, 3, 4, 5, 6], chunksize=chunksize):
+        chunk.columns = FA_COLUMNS
+        yield chunk.astype(FA_CACHE_DTYPES)
+
+
+# First pass: per-tag X/Y/Z ranges over all files, the same report as detect_drop_inactive_tags
+def scan_tag_ranges(filenames, chunksize=500000):
+    mins, maxs = [], []
+    for filename in filenames:
+        for chunk in iter_FA_chunks(filename, chunksize):
+            grouped = chunk.groupby('ID')[['X', 'Y', 'Z']]
+            # fold into the running extent right away so only one row per tag is kept
+            mins = [pd.concat(mins + [grouped.min()]).groupby(level=0).min()]
+            maxs = [pd.concat(maxs + [grouped.max()]).groupby(level=0).max()]
+    extent = maxs[0] - mins[0]
+    return extent.rename(columns={'X': 'X_range', 'Y': 'Y_range', 'Z': 'Z_range'})
+
+
+# Stable sort by tag; rows of the same tag keep their order (carried rows stay first)
+def _sort_by_tag(frame):
+    order = np.argsort(frame['ID'].to_numpy(), kind='stable')
+    return frame.iloc[order].reset_index(drop=True)
+
+
+class StreamingPipeline:
+    def __init__(self, spike_threshold=200, kernel_size=41, mode='zero', stationary_tags=(), clean_axes=None):
+        self.spike_threshold = spike_threshold
+        self.kernel_size = kernel_size
+        self.mode = mode
+        self.clean_axes = list(clean_axes) if clean_axes else None
+        self.left, self.right = window_extent(kernel_size)
+        self.stationary_tags = np.asarray(list(stationary_tags))
+        self.carry = None      # last raw samples per tag, for the kinematics
+        self.pending = None    # samples waiting for `right` later samples of their tag
+        self.context = None    # last `left` emitted samples per tag, for the median window
+        self.sketches = KinematicsSketches()
+
+    # Kinematics of a chunk, continuing every tag from its carried samples
+    def _kinematics(self, raw):
+        raw = raw.assign(_carry=False)
+        if self.carry is not None:
+            raw = pd.concat([self.carry.assign(_carry=True), raw], ignore_index=True)
+        frame = calculate_herd_kinematics(raw)
+        columns = [col for col in raw.columns if col != '_carry']
+        self.carry = frame.groupby('ID', sort=False).tail(KINEMATICS_CARRY)[columns]
+        frame = frame[~frame['_carry']].drop(columns='_carry')
+        self.sketches.update(frame)
+        return frame
+
+    # Spike removal for every sample that now has its full median window
+    def _spikes(self, rows, final):
+        rows = rows.assign(_context=False)
+        parts = [rows]
+        if self.pending is not None:
+            parts.insert(0, self.pending)
+        if self.context is not None:
+            parts.insert(0, self.context)
+        seq = _sort_by_tag(pd.concat(parts, ignore_index=True)[rows.columns])
+        if len(seq) == 0:
+            return seq
+
+        # a sample is ready once `right` later samples of its tag are known (or at the end)
+        is_context = seq['_context'].to_numpy()
+        if final:
+            ready = ~is_context
+        else:
+            position = seq.groupby('ID', sort=False).cumcount().to_numpy()
+            tag_length = seq.groupby('ID', sort=False)['ID'].transform('size').to_numpy()
+            ready = ~is_context & (position < tag_length - self.right)
+
+        done = seq[is_context | ready]
+        self.context = done.groupby('ID', sort=False).tail(self.left).assign(_context=True) if self.left else None
+        self.pending = seq[~is_context & ~ready]
+
+        out = seq[ready].drop(columns='_context')
+        if self.clean_axes:
+            fixed, spikes = remove_herd_spikes_multiaxis(seq, self.spike_threshold, self.kernel_size, self.mode,
+                                                         self.clean_axes)
+            for axis in self.clean_axes:
+                out[axis + '_raw'] = out[axis]
+                out[axis] = fixed[axis][ready].to_numpy()
+            out['Spike'] = spikes[ready].to_numpy()
+            return out
+        median_signal = segmented_rolling_median(seq['Y'], _tag_starts(seq['ID'].to_numpy()), self.kernel_size, self.mode)
+        fixed, spikes = _replace_spikes(out['Y'], median_signal[ready], self.spike_threshold, self.kernel_size)
+        return out.assign(Y_fixed=fixed, Spike=spikes)
+
+    # Process one chunk of raw rows and return the rows that are complete
+    def process(self, raw):
+        if len(self.stationary_tags):
+            raw = raw[~raw['ID'].isin(self.stationary_tags)]
+        if self.clean_axes:
+            rows = self._spikes(raw, final=False)
+            return self._kinematics(rows) if len(rows) else rows
+        return self._spikes(self._kinematics(raw), final=False)
+
+    # Emit the samples still waiting for right-hand context
+    def flush(self):
+        if self.pending is None:
+            return pd.DataFrame()
+        rows = self._spikes(self.pending.drop(columns='_context').iloc[0:0], final=True)
+        return self._kinematics(rows) if self.clean_axes and len(rows) else rows
+
+
+# Run the pipeline over FA files chunk by chunk and append the results to a CSV file
+def stream_pipeline(filenames, output_file, spike_threshold=200, kernel_size=41, mode='zero',
+                    chunksize=500000, y_range_threshold=2600, percentile=95, sketch_file=None, clean_axes=None):
+    print("Scanning tag ranges.")
+    report = scan_tag_ranges(filenames, chunksize)
+    stationary = report.index[report['Y_range'].abs() <= y_range_threshold]
+    print("Stationary Tags Removed: ", len(stationary))
+
+    pipeline = StreamingPipeline(spike_threshold, kernel_size, mode, stationary, clean_axes)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    rows_written = 0
+    for filename in filenames:
+        print(filename)
+        for chunk in iter_FA_chunks(filename, chunksize):
+            rows_written += _append_csv(pipeline.process(chunk), output_file)
+    rows_written += _append_csv(pipeline.flush(), output_file)
+    print(f"Rows written: {rows_written}")
+    print(f"The calculated velocity threshold is: {pipeline.sketches.percentile('Velocity', percentile)}")
+    print(f"The calculated acceleration threshold is: {pipeline.sketches.percentile('Acceleration', percentile)}")
+    if sketch_file is not None:
+        pipeline.sketches.save(sketch_file)
+    return rows_written
+
+
+def _append_csv(rows, output_file):
+    if len(rows) == 0:
+        return 0
+    rows.to_csv(output_file, mode='a', index=False, header=not os.path.exists(output_file))
+    return len(rows)
+
+
+if __name__ == "__main__":
+
+    # usage: python streaming_pipeline.py OUTPUT.csv FA_1.csv [FA_2.csv ...]
+    stream_pipeline(sys.argv[2:], sys.argv[1])
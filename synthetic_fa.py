@@ -0,0 +1,149 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+
+# Deterministic generator of FA-format CSV files (Column1, ID, Column3, Timestamp, X, Y, Z;
+# no header, one file per day named FA_YYYYMMDDT000000UTC.csv) for tests and benchmarks.
+# Cows alternate resting bouts with active bouts of slow movement (feeding, shuffling) and
+# now and then walk a few metres at about 1 m/s. Speed changes smoothly and the heading turns
+# gradually, so velocity is correlated from sample to sample; the measured position adds a
+# few tens of mm of noise. Stationary tags stay within a few hundred mm, and spikes and gaps
+# are injected at configurable rates. With these tracks the default spike settings flag
+# little more than the injected spikes. The same arguments always give the same files.
+
+BARN_X = (0, 20000)    # mm
+BARN_Y = (0, 17000)
+FIRST_TAG = 2417000
+MEAN_REST_S = 40 * 60        # mean length of resting and active bouts
+MEAN_ACTIVE_S = 15 * 60
+ACTIVE_SPEED_MM_S = 20       # median speed of an active bout (log-normal over bouts)
+WALKS_PER_HOUR = 2           # short walks at WALK_SPEED_MM_S, any time of the day
+MEAN_WALK_S = 15
+WALK_SPEED_MM_S = (500, 1200)
+SPEED_TAU_S = 3.0            # time constant of speed changes
+TURN_MM_S = 10.0             # sideways jitter of the heading; faster cows turn less
+POSITION_NOISE_MM = 30.0
+
+
+# Fold a free random walk back into [lo, hi] (reflecting walls)
+def _reflect(values, lo, hi):
+    span = hi - lo
+    folded = np.mod(values - lo, 2 * span)
+    return lo + np.where(folded > span, 2 * span - folded, folded)
+
+
+# Mask of the samples that survive the gaps: gaps start at `gap_rate` per sample and
+# last an exponential number of seconds with mean mean_gap_s
+def _gap_mask(rng, shape, gap_rate, mean_gap_s, sample_rate_hz):
+    keep = np.ones(shape, dtype=bool)
+    if gap_rate <= 0:
+        return keep
+    tag_idx, start = np.nonzero(rng.random(shape) < gap_rate)
+    length = np.maximum(1, rng.exponential(mean_gap_s * sample_rate_hz, len(start)).astype(np.int64))
+    for t, s, n in zip(tag_idx, start, length):
+        keep[t, s:s + n] = False
+    return keep
+
+
+# Speed (mm/s) of every sample: 0 while resting, one log-normal level per active bout,
+# and short walks on top, smoothed so that the speed never jumps
+def _speeds(rng, n_tags, n_samples, sample_rate_hz):
+    speeds = np.zeros((n_tags, n_samples))
+    mean_bout = np.array([MEAN_REST_S, MEAN_ACTIVE_S]) * sample_rate_hz
+    n_bouts = int(2 * n_samples / mean_bout.min()) + 2
+    for t in range(n_tags):
+        active = rng.random() < MEAN_ACTIVE_S / (MEAN_REST_S + MEAN_ACTIVE_S)
+        kinds = (np.arange(n_bouts) + active) % 2
+        ends = np.cumsum(np.maximum(1, rng.exponential(mean_bout[kinds])).astype(np.int64))
+        levels = kinds * ACTIVE_SPEED_MM_S * rng.lognormal(0, 0.5, n_bouts)
+        speeds[t] = levels[np.searchsorted(ends, np.arange(n_samples), side='right')]
+
+        walks = np.flatnonzero(rng.random(n_samples) < WALKS_PER_HOUR / (3600 * sample_rate_hz))
+        lengths = 1 + rng.exponential(MEAN_WALK_S * sample_rate_hz, len(walks)).astype(np.int64)
+        for start, length, speed in zip(walks, lengths, rng.uniform(*WALK_SPEED_MM_S, len(walks))):
+            speeds[t, start:start + length] = speed
+    a = np.exp(-1.0 / (SPEED_TAU_S * sample_rate_hz))
+    return lfilter([1 - a], [1, -a], speeds, axis=1)
+
+
+def generate_FA_day(day, n_tags=200, sample_rate_hz=1.0, n_stationary=10, spike_rate=0.01,
+                    gap_rate=0.0005, mean_gap_s=30.0, hours=24, seed=0, state=None):
+    """One day of FA rows for every tag, sorted by time like the real files.
+
+    `state` carries the positions and headings (x, y, heading) from the previous day so
+    multi-day data is continuous.
+    """
+    rng = np.random.default_rng([seed, day.toordinal()])
+    n_samples = int(hours * 3600 * sample_rate_hz)
+
+    # starting points of the tracks, and the fixed spots of the stationary tags
+    start_rng = np.random.default_rng([seed, 0])
+    anchors = np.column_stack([start_rng.uniform(*BARN_X, n_tags), start_rng.uniform(*BARN_Y, n_tags)])
+    if state is None:
+        state = np.column_stack([anchors, start_rng.uniform(0, 2 * np.pi, n_tags)])
+    speeds = _speeds(rng, n_tags, n_samples, sample_rate_hz)
+    turns = rng.standard_normal((n_tags, n_samples)) * TURN_MM_S / np.maximum(speeds, 10 * TURN_MM_S)
+    heading = state[:, 2:] + np.cumsum(turns / np.sqrt(sample_rate_hz), axis=1)
+    track_x = state[:, :1] + np.cumsum(speeds * np.cos(heading), axis=1) / sample_rate_hz
+    track_y = state[:, 1:2] + np.cumsum(speeds * np.sin(heading), axis=1) / sample_rate_hz
+    next_state = np.column_stack([track_x[:, -1], track_y[:, -1], heading[:, -1]])
+    x = _reflect(track_x, *BARN_X) + rng.normal(0, POSITION_NOISE_MM, (n_tags, n_samples))
+    y = _reflect(track_y, *BARN_Y) + rng.normal(0, POSITION_NOISE_MM, (n_tags, n_samples))
+
+    # stationary tags (e.g. tags lying on the floor) only jitter around a fixed point
+    n_stationary = min(n_stationary, n_tags)
+    if n_stationary:
+        x[-n_stationary:] = anchors[-n_stationary:, :1] + rng.normal(0, 50, (n_stationary, n_samples))
+        y[-n_stationary:] = anchors[-n_stationary:, 1:] + rng.normal(0, 50, (n_stationary, n_samples))
+
+    # spikes: single samples of moving tags thrown 0.5-3 m away in Y
+    spikes = rng.random((n_tags, n_samples)) < spike_rate
+    spikes[n_tags - n_stationary:] = False
+    y[spikes] += rng.choice([-1, 1], spikes.sum()) * rng.uniform(500, 3000, spikes.sum())
+
+    z = 1500 + rng.normal(0, POSITION_NOISE_MM, (n_tags, n_samples))
+    offset_ms = np.arange(n_samples) * (1000.0 / sample_rate_hz)
+    jitter_ms = rng.integers(0, int(500 / sample_rate_hz) + 1, (n_tags, n_samples))
+    day_ms = int(pd.Timestamp(day).value // 10**6)
+    timestamps = day_ms + offset_ms[None, :].astype(np.int64) + jitter_ms
+
+    keep = _gap_mask(rng, (n_tags, n_samples), gap_rate, mean_gap_s, sample_rate_hz)
+    ids = np.broadcast_to(FIRST_TAG + np.arange(n_tags)[:, None], (n_tags, n_samples))
+    frame = pd.DataFrame({
+        'Column1': 'FA',
+        'ID': ids[keep],
+        'Column3': 0,
+        'Timestamp': timestamps[keep],
+        'X': np.rint(x[keep]).astype(np.int64),
+        'Y': np.rint(y[keep]).astype(np.int64),
+        'Z': np.rint(z[keep]).astype(np.int64),
+    })
+    frame = frame.sort_values('Timestamp', kind='stable')
+    return frame, next_state
+
+
+# Write `days` daily FA files into output_dir and return their paths
+def generate_FA_files(output_dir, n_tags=200, days=1, start_date='2020-09-19', sample_rate_hz=1.0,
+                      n_stationary=10, spike_rate=0.01, gap_rate=0.0005, mean_gap_s=30.0, hours=24, seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = []
+    state = None
+    for day in pd.date_range(start_date, periods=days, freq='D'):
+        frame, state = generate_FA_day(day.date(), n_tags, sample_rate_hz, n_stationary, spike_rate,
+                                       gap_rate, mean_gap_s, hours, seed, state)
+        filename = os.path.join(output_dir, f"FA_{day:%Y%m%d}T000000UTC.csv")
+        frame.to_csv(filename, header=False, index=False)
+        filenames.append(filename)
+    return filenames
+
+
+if __name__ == "__main__":
+
+    # usage: python synthetic_fa.py OUTPUT_DIR [N_TAGS] [DAYS]
+    n_tags = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    for filename in generate_FA_files(sys.argv[1], n_tags, days):
+        print(filename)
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+from spikes_medfilt_v2 import (FAIndex, load_FA_arrays, _timestamps_as_ms, _segmented_diff, _angular_columns,
+                               _replace_spikes)
+from rolling_median import segmented_rolling_median
+
+
+# Compact trajectory store: one contiguous block of rows per tag, sorted by (tag, time),
+# with narrow base columns (int64 ms timestamps, int32 coordinates) and the tag ID kept
+# only once per tag. Kinematic columns (TimeDiff, Velocity, Theta, ...) are computed the
+# first time they are asked for and cached; release() frees them again.
+#
+# The base columns take 20 bytes per row, against over 100 bytes per row for the
+# DataFrame after calculate_herd_kinematics.
+
+BASE_COLUMNS = {'Timestamp': np.int64, 'X': np.int32, 'Y': np.int32, 'Z': np.int32}
+DERIVED_COLUMNS = ['TimeDiff', 'X_diff', 'Y_diff', 'Velocity', 'Acceleration',
+                   'Slope', 'Theta', 'Cosine', 'Theta_diff', 'Angular_velocity']
+ANGULAR_COLUMNS = DERIVED_COLUMNS[5:]
+
+
+class TrajectoryStore:
+    def __init__(self, tags, offsets, columns):
+        self.tags = np.asarray(tags, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = {col: np.ascontiguousarray(columns[col], dtype=dtype)
+                        for col, dtype in BASE_COLUMNS.items() if col in columns}
+        self._derived = {}
+
+    # Build from FA data in any row order (a DataFrame, an FAIndex or a dict of arrays
+    # such as load_FA_arrays() returns)
+    @classmethod
+    def from_frame(cls, data):
+        if isinstance(data, FAIndex):
+            data = data.data
+        if isinstance(data, pd.DataFrame):
+            arrays = {col: data[col].to_numpy() for col in BASE_COLUMNS if col in data.columns}
+            arrays['Timestamp'] = _timestamps_as_ms(data['Timestamp'])
+            ids = data['ID'].to_numpy()
+        else:
+            arrays = {col: np.asarray(data[col]) for col in BASE_COLUMNS if col in data}
+            ids = np.asarray(data['ID'])
+        if not _is_sorted_by_tag_and_time(ids, arrays['Timestamp']):
+            order = np.lexsort((arrays['Timestamp'], ids))
+            ids = ids[order]
+            arrays = {col: values[order] for col, values in arrays.items()}
+        tags, starts = np.unique(ids, return_index=True)
+        return cls(tags, np.append(starts, len(ids)), arrays)
+
+    # Build straight from the column cache of one or more FA files
+    @classmethod
+    def from_files(cls, filenames, cache_dir=None):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        parts = [load_FA_arrays(f, ['ID'] + list(BASE_COLUMNS), cache_dir) for f in filenames]
+        return cls.from_frame({col: np.concatenate([p[col] for p in parts]) for col in ['ID'] + list(BASE_COLUMNS)})
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __contains__(self, column):
+        return column in self.columns or column in DERIVED_COLUMNS or column == 'ID'
+
+    # First row of every tag as a boolean mask
+    def tag_starts(self):
+        starts = np.zeros(len(self), dtype=bool)
+        starts[self.offsets[:-1]] = True
+        return starts
+
+    # Tag position (category code) of every row
+    def codes(self):
+        dtype = np.int16 if len(self.tags) < 2**15 else np.int32
+        return np.repeat(np.arange(len(self.tags), dtype=dtype), np.diff(self.offsets))
+
+    # Row range [start, stop) of one tag, or (0, 0) if the tag is not present
+    def tag_bounds(self, individual_id):
+        i = np.searchsorted(self.tags, individual_id)
+        if i == len(self.tags) or self.tags[i] != individual_id:
+            return 0, 0
+        return self.offsets[i], self.offsets[i + 1]
+
+    # One column as an array; derived columns are computed on first use
+    def column(self, name):
+        if name in self.columns:
+            return self.columns[name]
+        if name == 'ID':
+            return self.tags[self.codes()]
+        if name not in DERIVED_COLUMNS:
+            raise KeyError(name)
+        if name not in self._derived:
+            self.materialize([name])
+        return self._derived[name]
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    # Compute and cache several derived columns at once. Intermediate columns that were
+    # not asked for (e.g. X_diff for Velocity) are not kept, except TimeDiff.
+    def materialize(self, names):
+        missing = [name for name in names if name not in self._derived]
+        unknown = [name for name in missing if name not in DERIVED_COLUMNS]
+        if unknown:
+            raise KeyError(unknown)
+        if not missing:
+            return
+        starts = self.tag_starts()
+        if 'TimeDiff' not in self._derived:
+            self._derived['TimeDiff'] = _segmented_diff(self.columns['Timestamp'], starts) / 1000.0
+        for axis in ('X_diff', 'Y_diff'):
+            if axis in missing:
+                self._derived[axis] = _segmented_diff(self.columns[axis[0]], starts)
+        velocity = self._derived.get('Velocity')
+        if velocity is None and ('Velocity' in missing or 'Acceleration' in missing):
+            dx = self._derived['X_diff'] if 'X_diff' in self._derived else _segmented_diff(self.columns['X'], starts)
+            dy = self._derived['Y_diff'] if 'Y_diff' in self._derived else _segmented_diff(self.columns['Y'], starts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                velocity = np.hypot(dx, dy) / self._derived['TimeDiff']
+            velocity[np.isnan(velocity)] = 0.0
+            if 'Velocity' in missing:
+                self._derived['Velocity'] = velocity
+        if 'Acceleration' in missing:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                acceleration = _segmented_diff(velocity, starts) / self._derived['TimeDiff']
+            acceleration[np.isnan(acceleration)] = 0.0
+            self._derived['Acceleration'] = acceleration
+        angular = [name for name in missing if name in ANGULAR_COLUMNS]
+        if angular:
+            # the angular columns come out of one pass, keep only the ones asked for
+            values = _angular_columns(self.columns['X'], self.columns['Y'], self._derived['TimeDiff'], starts)
+            for name in angular:
+                self._derived[name] = values[name]
+
+    # Drop cached derived columns (all of them by default) to free memory
+    def release(self, names=None):
+        for name in list(self._derived) if names is None else names:
+            self._derived.pop(name, None)
+
+    # Spike removal on one base column, the median window restarting at every tag
+    def remove_spikes(self, spike_threshold, kernel_size=41, mode='zero', column='Y'):
+        values = pd.Series(self.columns[column])
+        median_signal = segmented_rolling_median(values, self.tag_starts(), kernel_size, mode)
+        fixed, spikes = _replace_spikes(values, median_signal, spike_threshold, kernel_size)
+        return fixed.to_numpy(), spikes.to_numpy()
+
+    # Per-tag min/max range of a base column
+    def tag_ranges(self, column='Y'):
+        values = self.columns[column]
+        starts = self.offsets[:-1]
+        return pd.Series(np.maximum.reduceat(values, starts).astype(np.int64)
+                         - np.minimum.reduceat(values, starts), index=self.tags)
+
+    # A new store with only the given tags (base columns copied, nothing derived)
+    def select(self, tags):
+        keep = np.isin(self.tags, tags)
+        counts = np.diff(self.offsets)[keep]
+        rows = np.repeat(keep, np.diff(self.offsets))
+        return TrajectoryStore(self.tags[keep], np.append(0, np.cumsum(counts)),
+                               {col: values[rows] for col, values in self.columns.items()})
+
+    # Same rule as detect_drop_inactive_tags: drop tags whose Y range is at most the threshold
+    def drop_inactive(self, y_range_threshold=2600):
+        ranges = self.tag_ranges('Y')
+        return self.select(ranges.index[ranges.abs() > y_range_threshold])
+
+    # DataFrame for the plotting code. IDs come out as int64 (or categorical with
+    # categorical_ids=True), timestamps as ms (or datetimes with datetime=True).
+    def to_frame(self, columns=None, individual_id=None, datetime=False, categorical_ids=False):
+        if columns is None:
+            columns = ['ID'] + list(self.columns) + list(self._derived)
+        start, stop = (0, len(self)) if individual_id is None else self.tag_bounds(individual_id)
+        frame = {}
+        for col in columns:
+            if col == 'ID' and categorical_ids:
+                codes = self.codes()[start:stop]
+                frame[col] = pd.Categorical.from_codes(codes, categories=self.tags)
+            else:
+                frame[col] = self.column(col)[start:stop]
+        frame = pd.DataFrame(frame)
+        if datetime and 'Timestamp' in frame.columns:
+            frame['Timestamp'] = pd.to_datetime(frame['Timestamp'], unit='ms')
+        return frame
+
+    # Bytes held by the base columns, the tag table and the cached derived columns
+    def memory_usage(self):
+        base = sum(values.nbytes for values in self.columns.values()) + self.tags.nbytes + self.offsets.nbytes
+        derived = sum(values.nbytes for values in self._derived.values())
+        return {'base': base, 'derived': derived, 'total': base + derived}
+
+
+def _is_sorted_by_tag_and_time(ids, timestamps):
+    id_step = np.diff(ids)
+    return bool(np.all((id_step > 0) | ((id_step == 0) & (np.diff(timestamps) >= 0))))